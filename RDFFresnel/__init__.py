@@ -8,16 +8,36 @@
 # to group languages
 
 import sys
+import os
+import io
+import re
+import hashlib
+import pickle
+import tempfile
+import multiprocessing
+import threading
 from functools import reduce
 import itertools
+import functools
+import json
+import time
+import urllib.parse
+from collections import OrderedDict, Counter
 from logging import warning, info
 
 import rdflib
-from rdflib import URIRef, Graph, Namespace, Literal, BNode, URIRef
+from rdflib import URIRef, Graph, ConjunctiveGraph, Namespace, Literal, BNode, URIRef, Variable
 from rdflib.collection import Collection
 from rdflib import plugin
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.plugins.sparql.parserutils import CompValue, Expr
+from rdflib.store import TripleAddedEvent, TripleRemovedEvent
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
 
 from lxml import etree
+
+from . import fsl
 from lxml.builder import ElementMaker
 
 #plugin.register(
@@ -35,21 +55,860 @@ fresnelxml = "http://www.andonyar.com/rec/2012/sempipe/fresnelxml"
 
 E = ElementMaker(namespace=fresnelxml)
 
+# Pieces used to write XML documents piece by piece, see ContainerBox.write()
+_xmlDeclaration = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+_xmlnsDeclaration = ' xmlns:ns0="{0}"'.format(fresnelxml).encode("UTF-8")
+_xmlSplitMark = b"<!--rdffresnel-split-->"
+
 class FresnelException(Exception):
     pass
 
+class FresnelBudgetExceeded(FresnelException):
+    """Raised when a rendering creates more boxes than its BoxBudget allows"""
+    pass
+
 class MultilangLiteral(Literal):
     pass # TODO
 
+# Matches the beginning of a SPARQL ASK query up to the keyword ASK
+_askQueryHead = re.compile(r'^((?:\s+|#[^\n]*|(?:PREFIX|BASE)\s+(?:[^\s<]*\s*)?<[^>]*>)*)ASK\b', re.I)
+
+# Stands for the targets in the VALUES clause of a batch query, see
+# FresnelCache._batchText()
+_batchPlaceholder = "<urn:x-rdffresnel:target>"
+
+def _countValues(part):
+    """Counts the VALUES clauses in a SPARQL algebra expression"""
+    if not isinstance(part, CompValue):
+        return 0
+    if part.name == "values":
+        return 1
+    return sum(_countValues(v) for v in part.values())
+
+def _replaceValues(part, res):
+    """Returns a copy of a SPARQL algebra expression in which the rows
+    of the VALUES clause are replaced by res
+
+    Only the parts leading to the VALUES clause are copied. Expressions
+    are copied with their evaluation function, which clone() drops."""
+    if not _countValues(part):
+        return part
+    if isinstance(part, Expr):
+        evalfn = getattr(part._evalfn, "__func__", part._evalfn)
+        part = Expr(part.name, evalfn, **part)
+    else:
+        part = part.clone()
+    if part.name == "values":
+        part["res"] = res
+    for (k, v) in part.items():
+        if isinstance(v, CompValue):
+            part[k] = _replaceValues(v, res)
+    return part
+
+def _triplePatterns(prepared):
+    """Turns a compiled ASK query into a tuple of triple patterns
+
+    This works only if the WHERE clause of the query is a basic graph
+    pattern in which no variable except ?target turns up more than
+    once, and without property paths. In the patterns, ?target is kept
+    as Variable and the other variables are replaced by None. The
+    query is true for a target if every pattern, with the target put
+    in for ?target, matches a triple. For other queries, None is
+    returned."""
+    if isinstance(prepared, Literal):
+        return None
+    algebra = prepared.algebra
+    if algebra.name != "AskQuery" or algebra.datasetClause:
+        return None
+    part = algebra.p
+    if part.name == "Project":
+        part = part.p
+    if part.name != "BGP":
+        return None
+    target = Variable("target")
+    terms = [x for triple in part.triples for x in triple]
+    if not all(isinstance(x, (URIRef, Literal, Variable, BNode)) for x in terms):
+        return None
+    variables = [x for x in terms if isinstance(x, (Variable, BNode)) and x != target]
+    if len(variables) != len(set(variables)):
+        # A join, which needs the SPARQL engine
+        return None
+    return tuple(tuple(None if x in variables else x for x in triple)
+                 for triple in part.triples)
+
+class _QueryPickler(pickle.Pickler):
+    """Pickles compiled SPARQL queries
+
+    With the default reduction, the classes of rdflib's SPARQL algebra
+    can be pickled but not unpickled, since their constructors require
+    a name."""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, Expr):
+            evalfn = getattr(obj._evalfn, "__func__", obj._evalfn)
+            return (Expr, (obj.name, evalfn), None, None, iter(obj.items()))
+        if isinstance(obj, CompValue):
+            return (type(obj), (obj.name,), None, None, iter(obj.items()))
+        return NotImplemented
+
+def _dumpQuery(query):
+    f = io.BytesIO()
+    _QueryPickler(f, pickle.HIGHEST_PROTOCOL).dump(query)
+    return f.getvalue()
+
+# First line of files written by FresnelCache.fromFile(), followed by a hash
+_cacheFileHeader = b"RDFFresnel-cache-4"
+
+class _CachePickler(pickle.Pickler):
+    """Pickles a FresnelCache, leaving out the fresnel graph"""
+
+    def __init__(self, f, fresnelGraph):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.fresnelGraph = fresnelGraph
+
+    def persistent_id(self, obj):
+        return "fresnelGraph" if obj is self.fresnelGraph else None
+
+class _CacheUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return None
+
 class FresnelCache:
+    """Compiled lenses, formats, groups and SPARQL selectors of a
+    fresnel graph
+
+    Simple ASK selectors are not passed to the SPARQL engine, but
+    evaluated by looking up triple patterns in the instance graph,
+    see _triplePatterns(). Set nativeSelectors to False to disable
+    this. FSL selectors are parsed once, see fsl().
+
+    Instance graphs whose store is one of pushdownStores evaluate
+    SPARQL queries themselves, so selectors are passed to them as text
+    instead of being evaluated by rdflib on triple lookups, each of
+    which may be a round trip to the store."""
+
+    nativeSelectors = True
+    pushdownStores = (SPARQLStore,)
+
     def __init__(self, fresnelGraph):
         self.fresnelGraph = fresnelGraph
-        lensNodes = fresnelGraph.subjects(rdf.type, fresnel.Lens)        
-        self.lenses = [Lens(self.fresnelGraph, node) for node in lensNodes]
-        fmtNodes = fresnelGraph.subjects(rdf.type, fresnel.Format)        
+        # Lenses are compiled once. Lenses that are only referred to as
+        # sublenses end up in lensesByNode, too.
+        self.lensesByNode = dict()
+        lensNodes = fresnelGraph.subjects(rdf.type, fresnel.Lens)
+        self.lenses = [self.lensesByNode[node] if node in self.lensesByNode
+                       else Lens(self.fresnelGraph, node, self.lensesByNode)
+                       for node in lensNodes]
+        fmtNodes = fresnelGraph.subjects(rdf.type, fresnel.Format)
         self.fmts = [Format(self.fresnelGraph, node) for node in fmtNodes]
-        groupNodes = fresnelGraph.subjects(rdf.type, fresnel.Group)        
+        groupNodes = fresnelGraph.subjects(rdf.type, fresnel.Group)
         self.groups = [Group(self.fresnelGraph, node) for node in groupNodes]
+        # Indexes used to find lens and format candidates quickly.
+        # Label lenses get their own index, since only they can match
+        # inside of a label.
+        self.lensIndex = SelectorIndex(self.lenses)
+        self.labelLensIndex = SelectorIndex([l for l in self.lenses if fresnel.labelLens in l.purposes])
+        self.fmtIndex = SelectorIndex(self.fmts)
+        # SPARQL selectors are parsed once, using the namespace
+        # prefixes of the fresnel graph.
+        self.namespaces = dict(fresnelGraph.namespaces())
+        self.queries = dict()
+        self.batchQueries = dict()
+        self.patterns = dict()
+        self.fslExpressions = dict()
+        self.queryStats = {"compiled": 0, "compileTime": 0.0,
+                           "executed": 0, "executeTime": 0.0,
+                           "native": 0, "pushedDown": 0}
+        for (selector, arcs) in self._selectors():
+            if not isinstance(selector, Literal):
+                continue
+            if selector.datatype == fresnel.sparqlSelector:
+                self.prepare(selector)
+            elif selector.datatype == fresnel.fslSelector:
+                try:
+                    self.fsl(selector, arcs)
+                except FresnelException as e:
+                    warning(str(e))
+        for lof in itertools.chain(self.lensesByNode.values(), self.fmts):
+            for selector in lof.propertySelectors:
+                if isinstance(selector, Literal) and selector.datatype == fresnel.fslSelector:
+                    try:
+                        if self.propertyDomain(selector) is None:
+                            warning("fslSelector {} of {} does not only test the property, "
+                                    "it never matches".format(str(selector), str(lof)))
+                    except FresnelException:
+                        pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["queries"] = {s: q if isinstance(q, Literal) else _dumpQuery(q)
+                            for (s, q) in self.queries.items()}
+        state["batchQueries"] = {s: q and _dumpQuery(q)
+                                 for (s, q) in self.batchQueries.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        try:
+            self.queries = {s: q if isinstance(q, Literal) else pickle.loads(q)
+                            for (s, q) in state["queries"].items()}
+            self.batchQueries = {s: q and pickle.loads(q)
+                                 for (s, q) in state["batchQueries"].items()}
+        except Exception:
+            # Pickled with an incompatible version of rdflib, compile
+            # the queries again
+            self.queries = dict()
+            self.batchQueries = dict()
+            for selector in state["queries"]:
+                self.prepare(selector)
+
+    @classmethod
+    def fromFile(cls, lensFile, format=None, cacheFile=None):
+        """Returns a FresnelCache for the lenses in the file lensFile
+
+        If cacheFile is given, the FresnelCache is stored there
+        together with a hash of the contents of lensFile. As long as
+        lensFile does not change, later calls load the FresnelCache
+        from cacheFile instead of parsing lensFile and compiling the
+        lenses again. A FresnelCache loaded this way has no
+        fresnelGraph. cacheFile is unpickled, so it must not be
+        writable by anybody who must not run code."""
+        digest = hashlib.sha256()
+        with open(lensFile, "rb") as f:
+            digest.update(f.read())
+        digest.update(str((format, rdflib.__version__)).encode("UTF-8"))
+        header = _cacheFileHeader + b" " + digest.hexdigest().encode("ascii") + b"\n"
+        if cacheFile and os.path.exists(cacheFile):
+            try:
+                with open(cacheFile, "rb") as f:
+                    if f.readline() == header:
+                        return _CacheUnpickler(f).load()
+                info("{} is outdated, rebuilding it".format(cacheFile))
+            except Exception as e:
+                warning("Can not load {}, rebuilding it: {}".format(cacheFile, e))
+        cache = cls(Graph().parse(lensFile, format=format))
+        if cacheFile:
+            # Write to a temporary file first, so that no other process
+            # sees a partially written cache
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cacheFile)), delete=False) as f:
+                f.write(header)
+                _CachePickler(f, cache.fresnelGraph).dump(cache)
+            os.replace(f.name, cacheFile)
+        return cache
+
+    def _selectors(self):
+        """Yields the selectors of all lenses and formats, each paired
+        with a flag telling whether it selects properties"""
+        for lof in itertools.chain(self.lensesByNode.values(), self.fmts):
+            for selector in lof.instanceSelectors:
+                yield (selector, False)
+            for selector in lof.propertySelectors:
+                yield (selector, True)
+        for lens in self.lensesByNode.values():
+            for descr in lens.showProperties:
+                for selector in descr.properties:
+                    yield (selector, True)
+
+    def fsl(self, selector, arcs=False):
+        """Returns the parsed form of a fresnel:fslSelector literal
+
+        arcs tells whether the paths of the expression start with an
+        arc step, see fsl.parse(). Raises FresnelException if the
+        expression is invalid."""
+        key = (selector, arcs)
+        if key not in self.fslExpressions:
+            try:
+                self.fslExpressions[key] = fsl.parse(str(selector), self.namespaces, arcs)
+            except fsl.FSLError as e:
+                self.fslExpressions[key] = e
+        expression = self.fslExpressions[key]
+        if isinstance(expression, fsl.FSLError):
+            raise FresnelException("Invalid fslSelector {}: {}".format(str(selector), expression))
+        return expression
+
+    def propertyDomain(self, selector):
+        """Returns the parsed form of the fslSelector selector of a
+        property domain, or None if it can not be checked on the
+        property alone (see fsl.Expression.isPropertyTest()), in which
+        case it never matches"""
+        expression = self.fsl(selector, True)
+        return expression if expression.isPropertyTest() else None
+
+    def prepare(self, selector):
+        """Returns the compiled form of a fresnel:sparqlSelector literal
+
+        If the query can not be compiled with the namespace prefixes
+        of the fresnel graph, the literal itself is returned, so that
+        the query is passed unchanged to the instance graph."""
+        if selector in self.queries:
+            return self.queries[selector]
+        if not (isinstance(selector, Literal) and selector.datatype == fresnel.sparqlSelector):
+            return None
+        start = time.perf_counter()
+        try:
+            prepared = prepareQuery(str(selector), initNs=self.namespaces)
+        except Exception:
+            info("Can not compile sparqlSelector, it will be parsed on every use\n{}".format(str(selector)))
+            prepared = selector
+        self.queryStats["compiled"] += 1
+        self.queryStats["compileTime"] += time.perf_counter() - start
+        self.queries[selector] = prepared
+        self.batchQueries[selector] = self._batchQuery(selector, prepared)
+        self.patterns[selector] = _triplePatterns(prepared)
+        return prepared
+
+    def _batchQuery(self, selector, prepared):
+        """Rewrites an ASK selector into a SELECT of the matching ?target
+
+        The SELECT query starts with a VALUES clause for ?target,
+        holding a placeholder which is replaced by askMany(). Returns
+        the compiled query, or None if the selector can not be
+        rewritten."""
+        if isinstance(prepared, Literal) or prepared.algebra.name != "AskQuery":
+            return None
+        text = self._batchText(selector)
+        if text is None:
+            return None
+        try:
+            batchQuery = prepareQuery(text, initNs=self.namespaces)
+        except Exception:
+            return None
+        if _countValues(batchQuery.algebra) != 1:
+            # The selector has a VALUES clause of its own
+            return None
+        return batchQuery
+
+    @staticmethod
+    def _batchText(selector):
+        """Returns the text of the batch query of selector, see
+        _batchQuery(), or None"""
+        m = _askQueryHead.match(str(selector))
+        if not m:
+            return None
+        rest = str(selector)[m.end():]
+        if "{" not in rest:
+            return None
+        (dataset, where) = rest.split("{", 1)
+        return m.group(1) + "SELECT DISTINCT ?target" + dataset + \
+            "{ VALUES ?target { " + _batchPlaceholder + " } " + where
+
+    def _pushdown(self, instanceGraph):
+        """Tells whether selectors are passed to the store of
+        instanceGraph as text, see pushdownStores"""
+        return isinstance(instanceGraph.store, self.pushdownStores)
+
+    def _query(self, instanceGraph, selector, targetNode):
+        """Runs the sparqlSelector selector with ?target bound to
+        targetNode and returns the result"""
+        if self._pushdown(instanceGraph):
+            self.queryStats["pushedDown"] += 1
+            return instanceGraph.query(str(selector), initNs=self.namespaces,
+                                       initBindings={ "target": targetNode })
+        return instanceGraph.query(self.prepare(selector), initBindings={ "target": targetNode })
+
+    def _native(self, instanceGraph, selector):
+        """Returns the triple patterns of selector if it can be
+        evaluated without the SPARQL engine on instanceGraph"""
+        if not self.nativeSelectors or self._pushdown(instanceGraph):
+            return None
+        if isinstance(instanceGraph, ConjunctiveGraph) and not instanceGraph.default_union:
+            # The default graph of the SPARQL query is not the union of
+            # the graphs, unlike for lookups
+            return None
+        self.prepare(selector)
+        return self.patterns.get(selector)
+
+    def ask(self, instanceGraph, selector, targetNode):
+        """Evaluates the sparqlSelector selector, an ASK query, with
+        ?target bound to targetNode and returns the answer"""
+        patterns = self._native(instanceGraph, selector)
+        if patterns is not None:
+            self.queryStats["native"] += 1
+            return all(tuple(targetNode if isinstance(x, Variable) else x for x in triple) in instanceGraph
+                       for triple in patterns)
+        start = time.perf_counter()
+        res = self._query(instanceGraph, selector, targetNode)
+        answer = res.askAnswer
+        self._executed(start)
+        return answer
+
+    def askMany(self, instanceGraph, selector, targetNodes):
+        """Evaluates the sparqlSelector selector, an ASK query, for each
+        of the targetNodes and returns the set of nodes for which the
+        answer is true.
+
+        If possible, the query is rewritten into one SELECT query that
+        binds ?target to all the URIs in targetNodes with a VALUES
+        clause. Blank nodes can not be passed this way and are
+        evaluated one by one, as are all nodes if the selector can not
+        be rewritten."""
+        if self._native(instanceGraph, selector) is not None:
+            return {n for n in targetNodes if self.ask(instanceGraph, selector, n)}
+        self.prepare(selector)
+        batchQuery = self.batchQueries.get(selector)
+        batched = (lambda n: isinstance(n, URIRef)) if batchQuery else (lambda n: False)
+        uris = [n for n in targetNodes if batched(n)]
+        matched = {n for n in targetNodes if not batched(n) and self.ask(instanceGraph, selector, n)}
+        if uris:
+            start = time.perf_counter()
+            if self._pushdown(instanceGraph):
+                self.queryStats["pushedDown"] += 1
+                values = " ".join(n.n3() for n in uris)
+                res = instanceGraph.query(self._batchText(selector).replace(_batchPlaceholder, values, 1),
+                                          initNs=self.namespaces)
+            else:
+                target = Variable("target")
+                algebra = _replaceValues(batchQuery.algebra, [{target: n} for n in uris])
+                res = instanceGraph.query(Query(batchQuery.prologue, algebra))
+            matched.update(row[0] for row in res)
+            self._executed(start)
+        return matched
+
+    def select(self, instanceGraph, selector, targetNode):
+        """Evaluates the sparqlSelector selector, a SELECT query, with
+        ?target bound to targetNode and returns a list of the rows"""
+        start = time.perf_counter()
+        rows = list(self._query(instanceGraph, selector, targetNode))
+        self._executed(start)
+        return rows
+
+    def _executed(self, start):
+        self.queryStats["executed"] += 1
+        self.queryStats["executeTime"] += time.perf_counter() - start
+
+class SelectorIndex:
+    """Index from selectors to the lenses or formats using them
+
+    Lenses and formats are filed under the nodes given as their
+    instance, class or property selectors. Lenses and formats having a
+    query as selector can not be indexed this way. They are kept in
+    separate lists which are considered for every target.
+
+    candidates() returns the lenses or formats that possibly match a
+    target. They still have to be checked with Context.matches(). They
+    are returned in the order in which they have been passed to the
+    constructor, so the choice between equally good matches is not
+    affected by the index."""
+
+    __slots__ = ("instances", "classes", "properties", "instanceQueries", "propertyQueries")
+
+    def __init__(self, lofs):
+        self.instances = dict()
+        self.classes = dict()
+        self.properties = dict()
+        self.instanceQueries = list()
+        self.propertyQueries = list()
+        for entry in enumerate(lofs):
+            lof = entry[1]
+            self._file(entry, lof.instanceSelectors, self.instances, self.instanceQueries)
+            self._file(entry, lof.classSelectors, self.classes, None)
+            self._file(entry, lof.propertySelectors, self.properties, self.propertyQueries)
+
+    @staticmethod
+    def _file(entry, selectors, index, queries):
+        for selector in selectors:
+            if isinstance(selector, Literal) and queries is not None:
+                if not queries or queries[-1] is not entry:
+                    queries.append(entry)
+            else:
+                index.setdefault(selector, []).append(entry)
+
+    def candidates(self, targetNode, types=(), prop=False):
+        """Returns a list of the lenses or formats that may match targetNode
+
+        types: the classes of targetNode, including superclasses.
+        prop: If True, targetNode is treated as property, otherwise as
+              instance."""
+        if prop:
+            entries = itertools.chain(self.properties.get(targetNode, ()), self.propertyQueries)
+        else:
+            entries = itertools.chain(
+                self.instances.get(targetNode, ()), self.instanceQueries,
+                *[self.classes.get(t, ()) for t in types])
+        found = dict(entries)
+        return [found[pos] for pos in sorted(found)]
+
+class TypeCache:
+    """Memoizes the classes of nodes, including superclasses
+
+    An instance is shared by a Context and all its clones, so the
+    rdf:type and rdfs:subClassOf closure of a node is computed only
+    once per rendering. If maxsize is given, the least recently used
+    entries are evicted as soon as more than maxsize nodes are cached.
+    hits and misses count the lookups, graphLookups the triple lookups
+    in the instance graph made to compute closures. The ranks of classes (see
+    classRank()) are cached as well, limited to maxsize classes in the
+    same way."""
+
+    __slots__ = ("maxsize", "hits", "misses", "graphLookups", "_types", "_ranks")
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.graphLookups = 0
+        self._types = OrderedDict()
+        self._ranks = OrderedDict()
+
+    def types(self, instanceGraph, node):
+        """Returns a frozenset of the classes of node"""
+        try:
+            types = self._types[node]
+        except KeyError:
+            self.misses += 1
+            self.graphLookups += 1
+            types = self._superclasses(instanceGraph, instanceGraph.objects(node, rdf.type))
+            self._types[node] = types
+            if self.maxsize is not None and len(self._types) > self.maxsize:
+                self._types.popitem(last=False)
+        else:
+            self.hits += 1
+            if self.maxsize is not None:
+                self._types.move_to_end(node)
+        return types
+
+    def classRank(self, instanceGraph, classNode):
+        """Returns the number of superclasses of classNode, including
+        itself
+
+        A class has a higher rank than each of its proper superclasses,
+        so the rank orders class matches by specificity."""
+        try:
+            rank = self._ranks[classNode][0]
+        except KeyError:
+            superclasses = self._superclasses(instanceGraph, (classNode,))
+            self._ranks[classNode] = (len(superclasses), superclasses)
+            if self.maxsize is not None and len(self._ranks) > self.maxsize:
+                self._ranks.popitem(last=False)
+            return len(superclasses)
+        if self.maxsize is not None:
+            self._ranks.move_to_end(classNode)
+        return rank
+
+    def _superclasses(self, instanceGraph, classes):
+        """Returns the frozenset of classes and all their superclasses"""
+        found = set()
+        pending = list(classes)
+        while pending:
+            c = pending.pop()
+            if c not in found:
+                found.add(c)
+                self.graphLookups += 1
+                pending.extend(instanceGraph.objects(c, rdfs.subClassOf))
+        return frozenset(found)
+
+    def clear(self):
+        self._types.clear()
+        self._ranks.clear()
+
+    def invalidate(self, subjects):
+        """Forgets the classes of the nodes which may change if triples
+        with the given subjects change (all, if subjects is None)"""
+        if subjects is None:
+            self.clear()
+            return
+        for (node, types) in list(self._types.items()):
+            if node in subjects or not types.isdisjoint(subjects):
+                del self._types[node]
+        for (classNode, (_, superclasses)) in list(self._ranks.items()):
+            if not superclasses.isdisjoint(subjects):
+                del self._ranks[classNode]
+
+    @property
+    def stats(self):
+        """Returns a dict with the number of hits, misses, cached nodes
+        and cached class ranks"""
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._types), "ranks": len(self._ranks),
+                "maxsize": self.maxsize}
+
+class BoxBudget:
+    """Limits the number of boxes created during a rendering
+
+    An instance is shared by a Context and all its clones. Every box
+    created spends one unit of it.
+
+    limit:    maximal number of boxes
+    truncate: If False, FresnelBudgetExceeded is raised as soon as
+              more than limit boxes are created. If True, selection
+              stops descending into resources, properties and labels
+              once the budget is exhausted, so the result is truncated
+              instead."""
+
+    __slots__ = ("limit", "truncate", "used", "truncated")
+
+    def __init__(self, limit, truncate=False):
+        self.limit = limit
+        self.truncate = truncate
+        self.used = 0
+        self.truncated = False
+
+    def spend(self):
+        self.used += 1
+        if self.used > self.limit and not self.truncate:
+            raise FresnelBudgetExceeded("More than {} boxes created".format(self.limit))
+
+    @property
+    def exhausted(self):
+        """True if the budget is used up and selection has to stop"""
+        if not self.truncate or self.used < self.limit:
+            return False
+        if not self.truncated:
+            warning("Budget of {} boxes exhausted, truncating output".format(self.limit))
+            self.truncated = True
+        return True
+
+class LRUPolicy:
+    """Eviction policy of a FragmentCache which evicts the least
+    recently used entry
+
+    An eviction policy is told about every key which is inserted into
+    the cache, found in it or removed from it, and picks the key to be
+    evicted next."""
+
+    def __init__(self):
+        self._keys = OrderedDict()
+
+    def inserted(self, key):
+        self._keys[key] = None
+
+    def used(self, key):
+        self._keys.move_to_end(key)
+
+    def removed(self, key):
+        del self._keys[key]
+
+    def victim(self):
+        return next(iter(self._keys))
+
+class FIFOPolicy(LRUPolicy):
+    """Eviction policy of a FragmentCache which evicts the oldest entry"""
+
+    def used(self, key):
+        pass
+
+class FragmentCache:
+    """Remembers rendered resources across renderings
+
+    An instance is set as fragmentCache of a Context and kept by its
+    clones and by newRendering(). ContainerBox.write() with
+    incremental=True then takes serialized resource elements from it
+    instead of rendering them again, see ContainerBox.renderCached().
+    Entries are keyed by Context.boxKey(), that is, by the resource
+    and everything in the context that influences its rendering,
+    including the graphs and the FresnelCache, so a FragmentCache may
+    be shared by differently configured contexts.
+
+    Along with every entry, the nodes whose triples were read while
+    rendering it are remembered (see Context.dependencies). changed()
+    invalidates an entry as soon as a triple with one of these nodes
+    as subject is added or removed, or any triple at all if the entry
+    used SPARQL selectors. watch() calls changed() for every change of
+    a graph.
+
+    maxsize:  maximal number of entries, or None
+    maxbytes: maximal total size of the entries in bytes, or None
+    policy:   eviction policy, LRUPolicy() if not given
+
+    hits, misses, evictions and invalidations count what happened,
+    see also stats. version is increased with every change."""
+
+    def __init__(self, maxsize=None, maxbytes=None, policy=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.policy = policy if policy is not None else LRUPolicy()
+        self.version = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = dict()
+        self._dependents = dict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """Returns the fragment stored for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.policy.used(key)
+            return entry[0]
+
+    def put(self, key, fragment, dependencies, version):
+        """Stores the bytes fragment for key
+
+        dependencies are the nodes the fragment depends on, None
+        standing for the whole graph. version must be the value of
+        self.version from before rendering started. If the graph has
+        changed since, the fragment may be outdated and is dropped."""
+        with self._lock:
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (fragment, dependencies)
+            self.size += len(fragment)
+            self.policy.inserted(key)
+            for node in dependencies:
+                self._dependents.setdefault(node, set()).add(key)
+            while self._entries and (
+                    (self.maxsize is not None and len(self._entries) > self.maxsize) or
+                    (self.maxbytes is not None and self.size > self.maxbytes)):
+                self._remove(self.policy.victim())
+                self.evictions += 1
+
+    def _remove(self, key):
+        (fragment, dependencies) = self._entries.pop(key)
+        self.size -= len(fragment)
+        self.policy.removed(key)
+        for node in dependencies:
+            keys = self._dependents[node]
+            keys.discard(key)
+            if not keys:
+                del self._dependents[node]
+
+    def changed(self, subject=None):
+        """Invalidates the entries which depend on triples with the
+        given subject, or all entries if subject is None"""
+        with self._lock:
+            self.version += 1
+            if subject is None:
+                keys = set(self._entries)
+            else:
+                keys = self._dependents.get(subject, set()) | self._dependents.get(None, set())
+            for key in keys:
+                self._remove(key)
+                self.invalidations += 1
+
+    def watch(self, graph):
+        """Calls changed() whenever a triple is added to or removed
+        from graph
+
+        Additions are taken from the events of the store of graph.
+        Some stores, among them rdflib's default Memory store, do not
+        announce removed triples, so graph.remove() is replaced by a
+        method which calls changed() for the subjects of the removed
+        triples. Triples removed from the store directly, bypassing
+        graph, are only noticed if the store announces them."""
+        def handler(event):
+            self.changed(event.triple[0])
+        graph.store.dispatcher.subscribe(TripleAddedEvent, handler)
+        graph.store.dispatcher.subscribe(TripleRemovedEvent, handler)
+        remove = graph.remove
+        def removeWatched(triple):
+            subjects = {s for (s, _, _) in graph.triples(triple)}
+            result = remove(triple)
+            for subject in subjects:
+                self.changed(subject)
+            return result
+        graph.remove = removeWatched
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            for key in list(self._entries):
+                self._remove(key)
+
+    @property
+    def hitRate(self):
+        """Fraction of lookups which found an entry, None before the first"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    @property
+    def stats(self):
+        """Returns a dict with the counters, the hit rate and the size"""
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": self.hitRate, "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries), "bytes": self.size,
+                "maxsize": self.maxsize, "maxbytes": self.maxbytes}
+
+class Profiler:
+    """Records where a rendering spends its time
+
+    Profiling is enabled by setting an instance as profiler of a
+    Context. It is shared by all clones and by newRendering(), and
+    records
+
+    phases:    seconds spent in select, portray and transform (which
+               includes serialization, for ContainerBox.write()), as
+               measured by ContainerBox
+    matches:   number of Context.matches() calls per lens or format
+    selectors: number of executions of each SPARQL and FSL selector,
+               and the seconds they took, keyed by (language,
+               selector). The language is "native" for ASK selectors
+               evaluated as triple lookups and "pushdown" for SPARQL
+               selectors evaluated by the store, see
+               FresnelCache.pushdownStores. A batch evaluated by
+               Context.prefetch() counts as one execution.
+    lookups:   number of triple lookups in the instance graph made by
+               RDFFresnel itself (not counting the ones of selectors),
+               by purpose: "types" for computing type closures (each
+               rdf:type and rdfs:subClassOf lookup), "arcs" for
+               fetching the arcs of resources
+    boxes:     number of boxes created, per class
+
+    summary() returns all of it. Worker processes of
+    ContainerBox.renderParallel() record into copies of their own,
+    which are lost."""
+
+    __slots__ = ("phases", "matches", "selectors", "lookups", "boxes")
+
+    def __init__(self):
+        self.phases = Counter()
+        self.matches = Counter()
+        self.selectors = dict()
+        self.lookups = Counter()
+        self.boxes = Counter()
+
+    def selectorExecuted(self, language, selector, seconds):
+        stats = self.selectors.setdefault((language, selector), [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def summary(self, context=None):
+        """Returns what has been recorded as dict, ready for
+        json.dumps(). If context is given, the statistics of its caches
+        are included."""
+        summary = {
+            "phases": dict(self.phases),
+            "matches": [{"lof": str(node), "calls": calls}
+                        for (node, calls) in self.matches.most_common()],
+            "selectors": [{"language": language, "selector": str(selector),
+                           "executions": executions, "seconds": seconds}
+                          for ((language, selector), (executions, seconds))
+                          in sorted(self.selectors.items(), key=lambda x: -x[1][1])],
+            "lookups": dict(self.lookups),
+            "boxes": dict(self.boxes),
+        }
+        if context is not None:
+            summary["caches"] = {"types": context.typeCache.stats,
+                                 "queries": dict(context.fresnelCache.queryStats)}
+            if context.fragmentCache is not None:
+                summary["caches"]["fragments"] = context.fragmentCache.stats
+        return summary
+
+def _phase(name):
+    """Decorator for methods of ContainerBox which adds the time they
+    take to the phase name of the profiler of the context, if any"""
+    def decorator(method):
+        @functools.wraps(method)
+        def timed(self, *args):
+            profiler = self.context.profiler
+            if profiler is None:
+                return method(self, *args)
+            start = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                profiler.phases[name] += time.perf_counter() - start
+        return timed
+    return decorator
 
 class Context:
     """Rendering Context
@@ -67,12 +926,49 @@ class Context:
     lensGraph:      Graph which contains the lenses
     langs:          A tuple of acceptable languages, in descending
                     order of quality
+    typeCache:      TypeCache shared by all clones. A new one is
+                    created if not given.
+    selectorResults: dict shared by all clones which remembers the
+                    answers of SPARQL selectors, keyed by selector and
+                    target node.
+    batchSelectors: If True, the SPARQL selectors that may be needed
+                    for a list of sibling resources are evaluated for
+                    all of them at once, see prefetch().
+    memo:           None, or a dict shared by all clones in which
+                    selected boxes are remembered, see selectBox().
+                    Use a new dict for every rendering.
+    path:           A tuple of the resources currently being selected,
+                    outermost first. Used to detect cycles.
+    cyclePolicy:    What to do with a resource which is already on
+                    the path:
+                    None:        nothing, only depth limits recursion
+                    "stop":      select no properties for it, as if
+                                 the depth was exhausted
+                    "reference": render only a reference to it
+                    an int n:    allow it to turn up n more times on
+                                 the path, then stop
+    budget:         None, or a BoxBudget shared by all clones
+    fragmentCache:  None, or a FragmentCache shared by all clones and
+                    renderings
+    dependencies:   None, or a set shared by all clones to which the
+                    nodes are added whose triples are read, None
+                    standing for the whole graph. If set, every
+                    ResourceBox and LabelBox records its reads in a
+                    set of its own, see Box.dependencies. Used by
+                    FragmentCache and ContainerBox.update().
+    bulkArcs:       If True, all arcs of a resource are fetched from
+                    instanceGraph at once instead of one property
+                    after the other, see PropertyBoxList.
+    profiler:       None, or a Profiler shared by all clones
     """
 
     __slots__ = ("fresnelGraph", "instanceGraph", "baseNode", "group",
                  "lensCandidates", "fmtCandidates", "fresnelCache",
                  "depth", "label", "langs", 
-                 "fallbackLens", "fallbackLabelLens")
+                 "fallbackLens", "fallbackLabelLens", "typeCache",
+                 "selectorResults", "batchSelectors", "memo",
+                 "path", "cyclePolicy", "budget", "fragmentCache",
+                 "dependencies", "bulkArcs", "profiler")
     
     def __init__(self, **opts):
         self.baseNode = False
@@ -85,6 +981,17 @@ class Context:
         self.langs = ("en","en-GB","en-US","de","de-CH","jbo")
         self.fallbackLens = None
         self.fallbackLabelLens = None
+        self.typeCache = None
+        self.selectorResults = None
+        self.batchSelectors = False
+        self.memo = None
+        self.path = ()
+        self.cyclePolicy = None
+        self.budget = None
+        self.fragmentCache = None
+        self.dependencies = None
+        self.bulkArcs = False
+        self.profiler = None
         if "other" in opts:
             other = opts["other"]
             self.fresnelGraph = other.fresnelGraph
@@ -99,11 +1006,26 @@ class Context:
             self.langs = other.langs
             self.fallbackLens = other.fallbackLens
             self.fallbackLabelLens = other.fallbackLabelLens
+            self.typeCache = other.typeCache
+            self.selectorResults = other.selectorResults
+            self.batchSelectors = other.batchSelectors
+            self.memo = other.memo
+            self.path = other.path
+            self.cyclePolicy = other.cyclePolicy
+            self.budget = other.budget
+            self.fragmentCache = other.fragmentCache
+            self.dependencies = other.dependencies
+            self.bulkArcs = other.bulkArcs
+            self.profiler = other.profiler
             del opts["other"] 
         for (k,v) in opts.items():
             setattr(self, k, v)
         if not self.fresnelCache:
             self.fresnelCache = FresnelCache(self.fresnelGraph)
+        if self.typeCache is None:
+            self.typeCache = TypeCache()
+        if self.selectorResults is None:
+            self.selectorResults = dict()
 
     def clone(self, **changes):
         newctx = Context(other=self)
@@ -111,18 +1033,83 @@ class Context:
             setattr(newctx, k, v)
         return newctx
 
+    def newRendering(self):
+        """Returns a clone for another rendering
+
+        The clone shares graphs and FresnelCache with this context,
+        but has its own per-rendering state: caches, memo and
+        budget."""
+        budget = self.budget and BoxBudget(self.budget.limit, self.budget.truncate)
+        return self.clone(typeCache=TypeCache(self.typeCache.maxsize),
+                          selectorResults=dict(),
+                          memo=dict() if self.memo is not None else None,
+                          budget=budget)
+
+    def selectBox(self, boxClass, node):
+        """Creates a box of class boxClass for node and selects it
+
+        If memo is set, boxes are shared: If a box for node has
+        already been selected in an equivalent context, it (or rather
+        box.share(self)) is returned instead. This way, resources and
+        properties which turn up many times are selected only once."""
+        if self.memo is None:
+            box = boxClass(self, node)
+            box.select()
+            return box
+        key = self.boxKey(boxClass, node)
+        box = self.memo.get(key)
+        if box is None:
+            box = boxClass(self, node)
+            box.select()
+            self.memo[key] = box
+            return box
+        return box.share(self)
+
+    def boxKey(self, boxClass, node):
+        """Returns a key which is equal for all boxes of class boxClass
+        for node which are selected the same way in this context"""
+        return (boxClass, node, self.fresnelCache, self.instanceGraph,
+                tuple(self.lensCandidates) if self.lensCandidates else None,
+                tuple(self.fmtCandidates) if self.fmtCandidates else None,
+                self.depth, self.label, self.langs, self.group,
+                self.fallbackLens, self.fallbackLabelLens,
+                # With cycle detection, the result depends on the path
+                self.cyclePolicy, self.path if self.cyclePolicy is not None else None)
+
+    def dependOn(self, node):
+        """Records that the triples of node (or all triples, if node is
+        None) are read, see dependencies"""
+        if self.dependencies is not None:
+            self.dependencies.add(node)
+
+    def revisited(self, node):
+        """Tells whether node must not be selected again since it turns
+        up on the path too often, according to cyclePolicy"""
+        if self.cyclePolicy is None:
+            return False
+        allowed = self.cyclePolicy if isinstance(self.cyclePolicy, int) else 0
+        return self.path.count(node) > allowed
+
+    def exhausted(self):
+        """Tells whether selection has to stop since the budget is used up"""
+        return self.budget is not None and self.budget.exhausted
+
     def lens(self):
         """Returns the best lens for the baseNode in this context"""
         assert isinstance(self.baseNode, URIRef) or isinstance(self.baseNode, BNode)
 
         target = self.baseNode # The node we have to find a lens for
-        lenses = self.lensCandidates if self.lensCandidates else self.fresnelCache.lenses
+        if self.lensCandidates:
+            lenses = self.lensCandidates
+        else:
+            index = self.fresnelCache.labelLensIndex if self.label else self.fresnelCache.lensIndex
+            lenses = index.candidates(target, self.types(target))
         # Reduce to lenses that match
         lensesmatched = list(filter(lambda x: x[1], ((l,self.matches(l,target)) for l in lenses)))
         if not lensesmatched:
             info("No lens for {0}".format(target))
             return self.fallbackLabelLens if self.label else self.fallbackLens
-        lensesmatched.sort(key=lambda x: x[1])
+        lensesmatched.sort(key=lambda x: x[1].key())
         # Now get all lenses with maximal quality
         lensesmatched = [x for x in lensesmatched if x[1]==lensesmatched[0][1]]
         if (len(lensesmatched) > 1):
@@ -139,13 +1126,18 @@ class Context:
         assert isinstance(self.baseNode, URIRef) or isinstance(self.baseNode, BNode)
 
         target = self.baseNode
-        fmts = self.fmtCandidates if self.fmtCandidates else self.fresnelCache.fmts
+        if self.fmtCandidates:
+            fmts = self.fmtCandidates
+        elif prop:
+            fmts = self.fresnelCache.fmtIndex.candidates(target, prop=True)
+        else:
+            fmts = self.fresnelCache.fmtIndex.candidates(target, self.types(target))
 
         # Reduce to formats that match
         fmtsmatched = list(filter(lambda x: x[1], ((f,self.matches(f,target,prop)) for f in fmts)))
         if not fmtsmatched:
             return None
-        fmtsmatched.sort(key=lambda x: x[1])
+        fmtsmatched.sort(key=lambda x: x[1].key())
         # Now get all formats with maximal quality
         fmtsmatched = [x for x in fmtsmatched if x[1]==fmtsmatched[0][1]]
         if (len(fmtsmatched) > 1):
@@ -162,6 +1154,62 @@ class Context:
         This will have to be refactored to take a triple."""
         return self.clone(baseNode=propertyNode).fmt(True)
 
+    def types(self, node):
+        """Returns the set of classes of node, including superclasses"""
+        if self.profiler is not None:
+            lookups = self.typeCache.graphLookups
+            types = self.typeCache.types(self.instanceGraph, node)
+            self.profiler.lookups["types"] += self.typeCache.graphLookups - lookups
+        else:
+            types = self.typeCache.types(self.instanceGraph, node)
+        if self.dependencies is not None:
+            # The rdfs:subClassOf triples of the classes are read as well
+            self.dependencies.add(node)
+            self.dependencies.update(types)
+        return types
+
+    def classRank(self, classNode):
+        """Returns the rank of classNode, see TypeCache.classRank()"""
+        if self.profiler is not None:
+            lookups = self.typeCache.graphLookups
+            rank = self.typeCache.classRank(self.instanceGraph, classNode)
+            self.profiler.lookups["types"] += self.typeCache.graphLookups - lookups
+            return rank
+        return self.typeCache.classRank(self.instanceGraph, classNode)
+
+    def instancesOf(self, classNode):
+        """Returns a list of the resources of instanceGraph which are
+        instances of classNode or of one of its subclasses"""
+        classes = self.instanceGraph.transitive_subjects(rdfs.subClassOf, classNode)
+        return list(dict.fromkeys(
+            n for c in classes for n in self.instanceGraph.subjects(rdf.type, c)
+            if isinstance(n, (URIRef, BNode))))
+
+    def lensDomain(self, lensNode):
+        """Returns a list of the resources of instanceGraph which match
+        the domain of the lens lensNode
+
+        Resources are only considered if they are an instance selector
+        or an instance of a class selector of the lens, or, if the lens
+        has a SPARQL or FSL selector, if they are the subject of any
+        triple. Selector answers and types are remembered in the
+        caches of this context, so rendering the resources afterwards
+        with a clone of it does not compute them again."""
+        lens = self.fresnelCache.lensesByNode.get(lensNode)
+        if lens is None:
+            raise FresnelException("{} is not a lens".format(lensNode))
+        candidates = dict()
+        for selector in lens.instanceSelectors:
+            if isinstance(selector, Literal):
+                candidates.update(dict.fromkeys(
+                    n for n in self.instanceGraph.subjects() if isinstance(n, (URIRef, BNode))))
+            else:
+                candidates[selector] = None
+        for selector in lens.classSelectors:
+            candidates.update(dict.fromkeys(self.instancesOf(selector)))
+        self.prefetch(list(candidates))
+        return [n for n in candidates if self.matches(lens, n)]
+
     def matches(self, lof, targetNode, prop=False):
         """Determines whether the Lens or Format matches the targetNode
 
@@ -173,7 +1221,11 @@ class Context:
         is treated as property, otherwise as instance.
 
         sparqlSelectors are required to be ASK queries. This is _not_
-        according to the Fresnel specification."""
+        according to the Fresnel specification. fslSelectors match if
+        they select anything, see fsl."""
+
+        if self.profiler is not None:
+            self.profiler.matches[lof.node] += 1
 
         if self.label and not fresnel.labelLens in lof.purposes:
             return False
@@ -188,13 +1240,20 @@ class Context:
         matchQualities = list()
 
         try:
+            types = self.types(targetNode) if classSelectors else ()
+
             for selector in instanceSelectors:
                 if isinstance(selector, Literal):
                     # A SPARQL or FSL query
                     if selector.datatype == fresnel.sparqlSelector:
                         # selector should be a SPARQL ASK
-                        res = self.instanceGraph.query(selector, initBindings={ "?target": targetNode })
-                        if res.askAnswer:
+                        if self.ask(selector, targetNode):
+                            q = MatchQuality(self)
+                            q.reportInstanceMatch()
+                            q.reportRelativeQuery()
+                            matchQualities.append(q)
+                    elif selector.datatype == fresnel.fslSelector:
+                        if self.fslDomain(selector, targetNode):
                             q = MatchQuality(self)
                             q.reportInstanceMatch()
                             q.reportRelativeQuery()
@@ -208,9 +1267,6 @@ class Context:
                     matchQualities.append(q)
 
             for selector in classSelectors:
-                # TODO: subclass reasoning?
-                types = self.instanceGraph.objects(targetNode, rdf.type)
-                types = set(itertools.chain(*[self.instanceGraph.transitive_objects(t, rdfs.subClassOf, remember=None) for t in types]))
                 # We do not support SPQARQL or path queries for class
                 # selectors, in accordance with the specification.
                 if selector in types:
@@ -225,8 +1281,14 @@ class Context:
                     # A SPARQL or FSL query
                     if selector.datatype == fresnel.sparqlSelector:
                         # selector should be a SPARQL ASK
-                        res = self.instanceGraph.query(selector, initBindings={ "?target": targetNode })
-                        if res.askAnswer:
+                        if self.ask(selector, targetNode):
+                            q = MatchQuality(self)
+                            q.reportInstanceMatch()
+                            q.reportRelativeQuery()
+                            matchQualities.append(q)
+                    elif selector.datatype == fresnel.fslSelector:
+                        domain = self.fresnelCache.propertyDomain(selector)
+                        if domain is not None and domain.matchesProperty(targetNode):
                             q = MatchQuality(self)
                             q.reportInstanceMatch()
                             q.reportRelativeQuery()
@@ -243,6 +1305,90 @@ class Context:
 
         return max(matchQualities) if matchQualities else False
 
+    def ask(self, selector, targetNode):
+        """Returns the answer of the ASK sparqlSelector for targetNode
+
+        Answers are remembered in selectorResults."""
+        self.dependOn(None)
+        key = (selector, targetNode)
+        if key not in self.selectorResults:
+            self.selectorResults[key] = self.runSelector(
+                "sparql", selector, self.fresnelCache.ask, self.instanceGraph, selector, targetNode)
+        return self.selectorResults[key]
+
+    def runSelector(self, language, selector, function, *args):
+        """Returns function(*args), which evaluates selector, and
+        reports it to the profiler, if any"""
+        if self.profiler is None:
+            return function(*args)
+        if language == "sparql" and self.fresnelCache._native(self.instanceGraph, selector) is not None:
+            language = "native"
+        elif language == "sparql" and self.fresnelCache._pushdown(self.instanceGraph):
+            language = "pushdown"
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.profiler.selectorExecuted(language, selector, time.perf_counter() - start)
+
+    def fsl(self, selector, targetNode, arcs=False):
+        """Returns the list of (property, node) pairs which the
+        fslSelector selector selects starting from targetNode
+
+        arcs tells whether selector starts with an arc step. Results
+        are remembered in selectorResults."""
+        self.dependOn(None)
+        key = (selector, targetNode, arcs)
+        if key not in self.selectorResults:
+            expression = self.fresnelCache.fsl(selector, arcs)
+            self.selectorResults[key] = self.runSelector(
+                "fsl", selector, expression.select, self.instanceGraph, targetNode, self.types)
+        return self.selectorResults[key]
+
+    def fslDomain(self, selector, targetNode):
+        """Tells whether the fslSelector selector of a lens or format
+        domain selects targetNode, see fsl.Path.selectsNode()
+
+        Results are remembered in selectorResults."""
+        self.dependOn(None)
+        key = (selector, targetNode)
+        if key not in self.selectorResults:
+            expression = self.fresnelCache.fsl(selector)
+            self.selectorResults[key] = self.runSelector(
+                "fsl", selector, expression.selectsNode, self.instanceGraph, targetNode, self.types)
+        return self.selectorResults[key]
+
+    def prefetch(self, nodes):
+        """Evaluates SPARQL selectors for many nodes at once
+
+        Does nothing unless batchSelectors is set. Otherwise, each
+        SPARQL instance selector of the lenses and formats which are
+        candidates in this context is evaluated once for all of nodes,
+        and the answers are stored in selectorResults, where ask()
+        finds them later. So the selectors of L lenses are evaluated
+        with L queries instead of L times the number of nodes."""
+        if not self.batchSelectors:
+            return
+        nodes = [n for n in nodes if isinstance(n, URIRef) or isinstance(n, BNode)]
+        lenses = self.lensCandidates if self.lensCandidates else \
+            [lens for (_, lens) in self.fresnelCache.lensIndex.instanceQueries]
+        fmts = self.fmtCandidates if self.fmtCandidates else \
+            [fmt for (_, fmt) in self.fresnelCache.fmtIndex.instanceQueries]
+        selectors = {s for lof in itertools.chain(lenses, fmts) for s in lof.instanceSelectors
+                     if isinstance(s, Literal) and s.datatype == fresnel.sparqlSelector}
+        for selector in selectors:
+            pending = [n for n in nodes if (selector, n) not in self.selectorResults]
+            if not pending:
+                continue
+            try:
+                matched = self.runSelector("sparql", selector, self.fresnelCache.askMany,
+                                           self.instanceGraph, selector, pending)
+            except Exception:
+                # Errors are reported by matches() for the single nodes
+                continue
+            for n in pending:
+                self.selectorResults[(selector, n)] = n in matched
+
     def picklang(self, available_langs):
         """Poor man's language picking
 
@@ -253,6 +1399,8 @@ class Context:
         else: return None
 
 class FresnelNode:
+    __slots__ = ("fresnelGraph", "node")
+
     def __init__(self, fresnelGraph, node):
         self.fresnelGraph = fresnelGraph
         self.node = node
@@ -260,6 +1408,9 @@ class FresnelNode:
     def __eq__(self, other):
         return (self.node == other.node)
 
+    def __hash__(self):
+        return hash(self.node)
+
     def nodeProp(self, property):
         """Returns an object of the property or None if unknown"""
         objects = self.nodeProps(property)
@@ -293,7 +1444,12 @@ class MatchQuality():
     queries, we distinguish between queries that use are relative to
     the baseNode and queries that ignore it.
 
-    LensMatchQualities implements all comparisons.
+    LensMatchQualities implements all comparisons, by comparing the
+    tuples returned by key(). Among class matches, the match with a
+    subclass is better than the one with its superclass. This is
+    decided by the rank of the class (see TypeCache.classRank()), which
+    is looked up when the match is reported, so comparisons need no
+    access to the graph.
 
     Use the report* methods after initialisation in order to set the
     quality. Default values are not guarateed. Therefore you must
@@ -308,11 +1464,12 @@ class MatchQuality():
 
     Calling reportQuerySpecifity is optional, default is 0."""
 
-    __slots__ = ("env", "_classMatch", "_classNode", "_simple", "_relative", "_specifity")
+    __slots__ = ("env", "_classMatch", "_classNode", "_classRank", "_simple", "_relative", "_specifity")
 
     def __init__(self, env):
         self.env = env
         self._classMatch = True
+        self._classRank = 0
         self._simple = True
         self._relative = False
         self._specifity = 0
@@ -321,6 +1478,7 @@ class MatchQuality():
         """Call this to state that a classLensDomain matched"""
         self._classMatch = True
         self._classNode = classNode
+        self._classRank = self.env.classRank(classNode)
 
     def reportInstanceMatch(self):
         """Call this to state that a instanceLensDomain matched"""
@@ -344,142 +1502,104 @@ class MatchQuality():
         """Call this to set the specifity of the matching query"""
         self._specifity = specifity
 
-    def __le__(self, other):
-        if (self._classMatch and other._classMatch):
-            # class matches require a different handling
-            if other._classNode in self.env.instanceGraph.transitive_subjects(rdfs.subClassOf, self._classNode, remember=None):
-                return True
-            else:
-                return False
-        
-        quality = lambda q: (
-            not q._classMatch, # instanceLensDomain is preferred
-            q._simple, # simple selector is preferred
-            q._relative, # relative query is preferred
-            q._specifity, # otherwise order according to specifity
+    def key(self):
+        return (
+            not self._classMatch, # instanceLensDomain is preferred
+            self._simple, # simple selector is preferred
+            self._relative, # relative query is preferred
+            self._specifity, # otherwise order according to specifity
+            self._classRank, # subclasses are preferred
         )
-            
-        return quality(self) <= quality(other)
+
+    def __le__(self, other):
+        return self.key() <= other.key()
 
     # __ge__ is inferred py python
 
     def __lt__(self, other):
-        return self <= other and not self >= other
+        return self.key() < other.key()
 
     # __gt__ is inferred py python
 
     def __eq__(self, other):
-        return self <= other and other <= self
+        return self.key() == other.key()
 
 class Lens(FresnelNode):
-    def __init__(self, fresnelGraph, node):
-        super().__init__(fresnelGraph, node)
-
-    @property
-    def instanceSelectors(self):
-        """Returns the values of the fresnel:instanceLensDomain properties."""
-        return self.nodeProps(fresnel.instanceLensDomain)
+    """A fresnel:Lens
 
-    @property
-    def classSelectors(self):
-        """Returns the values of the fresnel:classLensDomain properties."""
-        return self.nodeProps(fresnel.classLensDomain)
-
-    @property
-    def propertySelectors(self):
-        """Returns an empty tuple, required by the matching algorithm.
+    All information about the lens is read from the fresnel graph when
+    the lens is constructed:
 
-        Lenses never match a property."""
-        return tuple()
+    instanceSelectors: values of the fresnel:instanceLensDomain properties
+    classSelectors:    values of the fresnel:classLensDomain properties
+    propertySelectors: empty tuple, required by the matching algorithm.
+                       Lenses never match a property.
+    purposes:          tuple of all purposes of this lens
+    groups:            tuple of all groups of this lens
+    showProperties:    tuple of PropertyDescription instances
+    hideProperties:    tuple of PropertyDescription instances
 
-    @property
-    def purposes(self):
-        """Returns a tuple of all purposes of this lens"""
-        return self.nodeProps(fresnel.purpose)
+    lenses: dict mapping nodes to the Lens instances constructed so
+            far. It is used to resolve sublenses, which may refer back
+            to lenses that are still being constructed. The new lens
+            adds itself to it."""
 
-    @property
-    def groups(self):
-        """Returns a tuple of all purposes of this lens"""
-        return self.nodeProps(fresnel.group)
+    __slots__ = ("instanceSelectors", "classSelectors", "propertySelectors",
+                 "purposes", "groups", "showProperties", "hideProperties")
 
-    @property
-    def showProperties(self):
-        """Returns a list of PropertyDescription instances"""
-        show = self.nodeProp(fresnel.showProperties)
-        if not show:
-            return []
-        if (show, rdf.first, None) in self.fresnelGraph:
-            # Note, that we can not expect a triple (show, rdf.type, rdf.List) 
+    def __init__(self, fresnelGraph, node, lenses=None):
+        super().__init__(fresnelGraph, node)
+        lenses = dict() if lenses is None else lenses
+        lenses[node] = self
+        self.instanceSelectors = self.nodeProps(fresnel.instanceLensDomain)
+        self.classSelectors = self.nodeProps(fresnel.classLensDomain)
+        self.propertySelectors = tuple()
+        self.purposes = self.nodeProps(fresnel.purpose)
+        self.groups = self.nodeProps(fresnel.group)
+        self.showProperties = self._propertyDescriptions(fresnel.showProperties, lenses)
+        self.hideProperties = self._propertyDescriptions(fresnel.hideProperties, lenses)
+
+    def _propertyDescriptions(self, property, lenses):
+        descrs = self.nodeProp(property)
+        if not descrs:
+            return tuple()
+        if (descrs, rdf.first, None) in self.fresnelGraph:
+            # Note, that we can not expect a triple (descrs, rdf.type, rdf.List)
             # to be present.
-            show = list(Collection(self.fresnelGraph, show))
-        else:
-            show = (show,)
-        return [PropertyDescription(self.fresnelGraph, s) for s in show]
-
-    @property
-    def hideProperties(self):
-        """Returns a list of PropertyDescription instances"""
-        hide = self.nodeProp(fresnel.hideProperties)
-        if not hide:
-            return []
-        if (show, rdf.first, None) in self.fresnelGraph.objects:
-            hide = list(Collection(self.fresnelGraph, hide))
+            descrs = list(Collection(self.fresnelGraph, descrs))
         else:
-            hide = (hide,)
-        return [PropertyDescription(self.fresnelGraph, s) for s in hide]
+            descrs = (descrs,)
+        return tuple(PropertyDescription(self.fresnelGraph, d, lenses) for d in descrs)
 
     def __str__(self):
         return "Lens({0})".format(self.node)
 
 class Group(FresnelNode):
-    def __init__(self, fresnelGraph, node):
-        super().__init__(fresnelGraph, node)
+    __slots__ = ()
 
-class Format(FresnelNode):
-    # TODO: We should handle values set by Groups!
     def __init__(self, fresnelGraph, node):
         super().__init__(fresnelGraph, node)
 
-    @property
-    def instanceSelectors(self):
-        """Returns the values of the fresnel:instanceFormatDomain properties."""
-        return self.nodeProps(fresnel.instanceFormatDomain)
-
-    @property
-    def classSelectors(self):
-        """Returns the values of the fresnel:classFormatDomain properties."""
-        return self.nodeProps(fresnel.classFormatDomain)
-
-    @property
-    def propertySelectors(self):
-        """Returns the values of the fresnel:propertyFormatDomains properties."""
-        return self.nodeProps(fresnel.propertyFormatDomain)
-
-    @property
-    def purposes(self):
-        """Returns empty tuple, required by the matching algorithm"""
-        return tuple()
+class Format(FresnelNode):
+    """A fresnel:Format
 
-    @property
-    def groups(self):
-        """Returns a tuple of all purposes of this lens"""
-        return self.nodeProps(fresnel.group)
+    All information about the format is read from the fresnel graph
+    when the format is constructed:
 
-    @property
-    def label(self):
-        """Indicates what should be taken as label, or None if not set.
+    instanceSelectors: values of the fresnel:instanceFormatDomain properties
+    classSelectors:    values of the fresnel:classFormatDomain properties
+    propertySelectors: values of the fresnel:propertyFormatDomain properties
+    purposes:          empty tuple, required by the matching algorithm
+    groups:            tuple of all groups of this format
 
+    label: Indicates what should be taken as label, or None if not set.
         possible values:
         fresnel:show (default)
         fresnel:none
         a string
-        http://www.w3.org/2005/04/fresnel-info/manual/#labelling"""
-        return self.nodeProp(fresnel.label)
-
-    @property
-    def value(self):
-        """Describes how the value should be displayed. Returns a node if set.
+        http://www.w3.org/2005/04/fresnel-info/manual/#labelling
 
+    value: Describes how the value should be displayed, a node or None.
         possible values:
         fresnel:image
         fresnel:externalLink
@@ -493,76 +1613,45 @@ class Format(FresnelNode):
             (Warning: This may be a security risk in automated tools.)
         sempfres:parsedForcefullyAsXML
             Parses a literal always as XML.
-        http://www.w3.org/2005/04/fresnel-info/manual/#displayingValues"""
-        return self.nodeProp(fresnel.value)
-
-    @property
-    def resourceStyle(self):
-        """Indicates the style of a resource
-
-        value: a literal of type fresnel:styleClass
-        http://www.w3.org/2005/04/fresnel-info/manual/#csshooking"""
-        return Style(self.nodeProps(fresnel.resourceStyle))
+        http://www.w3.org/2005/04/fresnel-info/manual/#displayingValues
 
-    @property
-    def propertyStyle(self):
-        """Indicates the style of a property
-
-        value: a literal of type fresnel:styleClass
-        http://www.w3.org/2005/04/fresnel-info/manual/#csshooking"""
-        return Style(self.nodeProps(fresnel.propertyStyle))
-
-    @property
-    def labelStyle(self):
-        """Indicates the style of a label
-
-        value: a literal of type fresnel:styleClass
-        http://www.w3.org/2005/04/fresnel-info/manual/#csshooking"""
-        return Style(self.nodeProps(fresnel.labelStyle))
-
-    @property
-    def valueStyle(self):
-        """Indicates the style of a value
-
-        value: a literal of type fresnel:styleClass
-        http://www.w3.org/2005/04/fresnel-info/manual/#csshooking"""
-        return Style(self.nodeProps(fresnel.valueStyle))
-
-    # Note: containerStyle only exists on groups
+    resourceStyle, propertyStyle, labelStyle, valueStyle:
+        The Style of a resource, property, label or value, given by
+        literals of type fresnel:styleClass or fresnel:stylingInstructions.
+        http://www.w3.org/2005/04/fresnel-info/manual/#csshooking
+        (Note: containerStyle only exists on groups)
 
-    @property
-    def valueFormat(self):
-        """Added content before of after a value box
+    resourceFormat, propertyFormat, labelFormat, valueFormat:
+        FormatHook adding content before or after a resource, property,
+        label or value box, or None."""
 
-        This is always a FormatHook"""
-        fmtHook = self.nodeProp(fresnel.valueFormat)
-        if fmtHook: fmtHook = FormatHook(self.fresnelGraph, fmtHook)
-        return fmtHook
-
-    @property
-    def propertyFormat(self):
-        """Added content before or after a property box
-
-        This is always a FormatHook"""
-        fmtHook = self.nodeProp(fresnel.propertyFormat)
-        if fmtHook: fmtHook = FormatHook(self.fresnelGraph, fmtHook)
-        return fmtHook
-
-    @property
-    def labelFormat(self):
-        """Added content before or after a label box
-
-        This is always a FormatHook"""
-        fmtHook = self.nodeProp(fresnel.labelFormat)
-        if fmtHook: fmtHook = FormatHook(self.fresnelGraph, fmtHook)
-        return fmtHook
+    # TODO: We should handle values set by Groups!
 
-    @property
-    def resourceFormat(self):
-        """Added content before or after a resource box
+    __slots__ = ("instanceSelectors", "classSelectors", "propertySelectors",
+                 "purposes", "groups", "label", "value",
+                 "resourceStyle", "propertyStyle", "labelStyle", "valueStyle",
+                 "resourceFormat", "propertyFormat", "labelFormat", "valueFormat")
 
-        This is always a FormatHook"""
-        fmtHook = self.nodeProp(fresnel.resourceFormat)
+    def __init__(self, fresnelGraph, node):
+        super().__init__(fresnelGraph, node)
+        self.instanceSelectors = self.nodeProps(fresnel.instanceFormatDomain)
+        self.classSelectors = self.nodeProps(fresnel.classFormatDomain)
+        self.propertySelectors = self.nodeProps(fresnel.propertyFormatDomain)
+        self.purposes = tuple()
+        self.groups = self.nodeProps(fresnel.group)
+        self.label = self.nodeProp(fresnel.label)
+        self.value = self.nodeProp(fresnel.value)
+        self.resourceStyle = Style(self.nodeProps(fresnel.resourceStyle))
+        self.propertyStyle = Style(self.nodeProps(fresnel.propertyStyle))
+        self.labelStyle = Style(self.nodeProps(fresnel.labelStyle))
+        self.valueStyle = Style(self.nodeProps(fresnel.valueStyle))
+        self.resourceFormat = self._formatHook(fresnel.resourceFormat)
+        self.propertyFormat = self._formatHook(fresnel.propertyFormat)
+        self.labelFormat = self._formatHook(fresnel.labelFormat)
+        self.valueFormat = self._formatHook(fresnel.valueFormat)
+
+    def _formatHook(self, property):
+        fmtHook = self.nodeProp(property)
         if fmtHook: fmtHook = FormatHook(self.fresnelGraph, fmtHook)
         return fmtHook
 
@@ -570,6 +1659,8 @@ class Format(FresnelNode):
         return "Format({0})".format(self.node)
 
 class Style:
+    __slots__ = ("nodes",)
+
     def __init__(self, styleNodes):
         # None is also a valid value for styleNodes
         self.nodes = tuple(styleNodes) if styleNodes is not None else tuple()
@@ -593,53 +1684,36 @@ class Style:
         return {k: v for (k,v) in attrs.items() if v}
 
 class FormatHook(FresnelNode):
-    def __init__(self, fresnelGraph, node):
-        super().__init__(fresnelGraph, node)
+    """Additional content around a box, see
+    http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent
 
-    @property
-    def contentBefore(self):
-        """Additional content before the current box
+    contentBefore:  Additional content before the current box
+    contentAfter:   Additional content after the current box
+    contentFirst:   Additional content at the beginning of a list of
+                    boxes, replaces the contentBefore of the first box.
+    contentLast:    Additional content at the end of a list of boxes,
+                    replaces the contentAfter of the last box.
+    contentNoValue: Shown when the property is missing"""
 
-        http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent"""
-        return self.nodeProp(fresnel.contentBefore)
-
-    @property
-    def contentAfter(self):
-        """Additional content after the current box
-
-        http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent"""
-        return self.nodeProp(fresnel.contentAfter)
-
-    @property
-    def contentFirst(self):
-        """Additional content at the beginning of a list of boxes,
-        replaces the contentBefore of the first box.
+    __slots__ = ("contentBefore", "contentAfter", "contentFirst", "contentLast", "contentNoValue")
 
-        http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent"""
-        return self.nodeProp(fresnel.contentFirst)
-
-    @property
-    def contentLast(self):
-        """Additional content at the end of a list of boxes,
-        replaces the contentAfter of the last box.
-
-        http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent"""
-        return self.nodeProp(fresnel.contentLast)
-
-    @property
-    def contentNoValue(self):
-        """Shown when the property is missing
-
-        http://www.w3.org/2005/04/fresnel-info/manual/#additionalcontent"""
-        return self.nodeProp(fresnel.contentNoValue)
+    def __init__(self, fresnelGraph, node):
+        super().__init__(fresnelGraph, node)
+        self.contentBefore = self.nodeProp(fresnel.contentBefore)
+        self.contentAfter = self.nodeProp(fresnel.contentAfter)
+        self.contentFirst = self.nodeProp(fresnel.contentFirst)
+        self.contentLast = self.nodeProp(fresnel.contentLast)
+        self.contentNoValue = self.nodeProp(fresnel.contentNoValue)
 
 
 class PropertyDescription(FresnelNode):
     __slots__ = ("sublenses", "properties", "depth", "label", "alt", "merge", "useFmt")
 
-    def __init__(self, fresnelGraph, node):
-        """node: property description in fresnel Graph"""
+    def __init__(self, fresnelGraph, node, lenses=None):
+        """node: property description in fresnel Graph
+        lenses: dict of already constructed lenses, see Lens"""
         super().__init__(fresnelGraph, node)
+        lenses = dict() if lenses is None else lenses
         if isinstance(self.node, Literal):
             # A query. Queryies are evaluated later, so we simply put the node
             # containing the query into self.properties.
@@ -651,7 +1725,8 @@ class PropertyDescription(FresnelNode):
             self.merge = False
             self.useFmt = None
         elif fresnel.PropertyDescription in self.nodeProps(rdf.type):
-            self.sublenses = [Lens(fresnelGraph, s) for s in self.nodeProps(fresnel.sublens)]
+            self.sublenses = tuple(lenses[s] if s in lenses else Lens(fresnelGraph, s, lenses)
+                                   for s in self.nodeProps(fresnel.sublens))
             props = self.nodeProps(fresnel.property)
             mergeprops = self.nodeProp(fresnel.mergeProperties)
             altprops = self.nodeProp(fresnel.alternateProperties)
@@ -668,8 +1743,9 @@ class PropertyDescription(FresnelNode):
                 self.alt = True
                 self.merge = False
             else:
-                FresnelException("Property description without fresnel:properties, fresnel:mergeProperties or fresnel:alternateProperties")
-            self.depth = self.nodeProp(fresnel.depth)
+                raise FresnelException("Property description without fresnel:properties, fresnel:mergeProperties or fresnel:alternateProperties")
+            depth = self.nodeProp(fresnel.depth)
+            self.depth = int(depth) if depth is not None else None
             self.label = self.nodeProp(fresnel.label)
             self.useFmt = None
             for f in self.nodeProps(fresnel.use):
@@ -689,24 +1765,34 @@ class PropertyBoxList():
     """A list of all properties of a resource as given by a lens. This
     class also takes care of processing property description and
     property queries the right way, even splitting them up if
-    required."""
+    required.
+
+    If the context has bulkArcs, the arcs of the resource are fetched
+    with a single predicate_objects() call, that is, a single lookup
+    in the store, and all property descriptions are resolved from
+    them."""
     
-    __slots__ = ("context", "_properties", "resourceNode", "lens")
+    __slots__ = ("context", "_properties", "resourceNode", "lens", "_arcs")
 
     def __init__(self, context, lens):
         self.context = context
         self.resourceNode = context.baseNode
         self.lens = lens
         self._properties = []
-
-        fresnelGraph = context.fresnelGraph
-        instanceGraph = context.instanceGraph
+        self._arcs = None
 
         show = lens.showProperties if lens else []
         hide = lens.hideProperties if lens else []
         # TODO: Expand hide to a set by resolving selectors
         if hide:
             raise FresnelException("fresnel:hide is not yet supported")
+        if show and context.bulkArcs:
+            if context.profiler is not None:
+                context.profiler.lookups["arcs"] += 1
+            self.context.dependOn(self.resourceNode)
+            self._arcs = dict()
+            for (p, v) in self.context.instanceGraph.predicate_objects(self.resourceNode):
+                self._arcs.setdefault(p, []).append(v)
         # TODO: iterate over show, always dropping elements of hide
         for descr in show:
             arcs = self.resolveDescription(descr)
@@ -723,11 +1809,12 @@ class PropertyBoxList():
                     self._properties.append(PropertyBox(self.context.clone(), arcs[0][0], descr, [v for (_,v) in arcs]))
             else:
                 # Add properties for every group of arcs with the same
-                # property.
-                for groupp in {p for (p,_) in arcs}:
-                    arcs_for_groupp = [(p,v) for (p,v) in arcs if p == groupp]
-                    if arcs_for_groupp:
-                        self._properties.append(PropertyBox(self.context.clone(), groupp, descr, [v for (_,v) in arcs_for_groupp]))
+                # property, in the order the properties turn up.
+                groups = dict()
+                for (p,v) in arcs:
+                    groups.setdefault(p, []).append(v)
+                for (groupp, values) in groups.items():
+                    self._properties.append(PropertyBox(self.context.clone(), groupp, descr, values))
 
     def resolveDescription(self, descr):
         """Takes a propertyDescription returns a list of arcs, i.e.
@@ -743,17 +1830,33 @@ class PropertyBoxList():
                 if prop.datatype == fresnel.sparqlSelector:
                     # selector should be a SPARQL SELECT
                     # It must have the bindings ?prop ?obj in this order.
+                    self.context.dependOn(None)
                     try:
-                        res = self.context.instanceGraph.query(prop, initBindings={ "?target": self.resourceNode })
+                        res = self.context.runSelector("sparql", prop, self.context.fresnelCache.select,
+                                                       self.context.instanceGraph, prop, self.resourceNode)
                     except:
                         raise FresnelException("Error while resolving sparqlSelector\n{}".format(str(prop)) )
                     for r in res:
                         if not (r[0] is None or isinstance(r[0], URIRef)):
                             raise FresnelException("SPARQL query returned a literal or a blank node as ?prop")
                         arcs.append((r[0],r[1]))
+                elif prop.datatype == fresnel.fslSelector:
+                    # The selected nodes, together with the property of
+                    # the last arc leading to them
+                    try:
+                        arcs += self.context.fsl(prop, self.resourceNode, arcs=True)
+                    except FresnelException:
+                        raise
+                    except Exception:
+                        raise FresnelException("Error while resolving fslSelector\n{}".format(str(prop)))
                 else:
                     raise FresnelException("Unsupported selector language {}".format(prop.datatype))
+            elif self._arcs is not None:
+                arcs += [(prop, v) for v in self._arcs.get(prop, ())]
             else:
+                if self.context.profiler is not None:
+                    self.context.profiler.lookups["arcs"] += 1
+                self.context.dependOn(self.resourceNode)
                 valueNodes = self.context.instanceGraph.objects(self.resourceNode, prop)
                 arcs += [(prop, v) for v in valueNodes]
         return arcs
@@ -765,11 +1868,50 @@ class PropertyBoxList():
         return self._properties.__get__(k)
 
 class Box:
-    __slots__ = ("context", "fmt", "style", "contentFirst", "contentBefore", "contentAfter", "contentLast", "contentNoValue")
+    """Base class of all boxes
+
+    dependencies: None, or the set of nodes whose triples were read
+                  while selecting and portraying this box (None
+                  standing for the whole graph), not counting the
+                  ResourceBoxes within it. Recorded by ResourceBox
+                  and LabelBox if the context has dependencies."""
+
+    __slots__ = ("context", "fmt", "style", "contentFirst", "contentBefore", "contentAfter", "contentLast", "contentNoValue", "dependencies")
 
     def __init__(self, context):
         for s in Box.__slots__: setattr(self, s, None)
         self.context = context
+        if context.budget is not None:
+            context.budget.spend()
+        if context.profiler is not None:
+            context.profiler.boxes[type(self).__name__] += 1
+
+    def children(self):
+        """Returns the boxes directly within this box"""
+        return []
+
+    def walk(self):
+        """Yields this box and all boxes within it, each once"""
+        seen = set()
+        stack = [self]
+        while stack:
+            box = stack.pop()
+            if id(box) in seen:
+                continue
+            seen.add(id(box))
+            yield box
+            stack.extend(box.children())
+
+    def allDependencies(self):
+        """Returns the union of the dependencies of all boxes within
+        this one"""
+        return set().union(*[b.dependencies for b in self.walk() if b.dependencies is not None])
+
+    def _recordDependencies(self):
+        # Reads of this box (and of the boxes sharing its context) go
+        # to a set of its own
+        if self.context.dependencies is not None:
+            self.dependencies = self.context.dependencies = set()
 
     def _transform_format(self):
         content = []
@@ -787,6 +1929,26 @@ class Box:
         else:
             return ""
 
+    def _transform_format_json(self):
+        """Returns what _transform_format() puts into the format
+        element, as a dict"""
+        fmt = dict()
+        for k in ("contentFirst", "contentBefore", "contentAfter", "contentLast", "contentNoValue"):
+            if getattr(self, k):
+                fmt[k] = str(getattr(self, k))
+        if self.style: fmt.update(self.style.attrs)
+        if self.fmt: fmt["fmt"] = str(self.fmt.node)
+        return fmt
+
+    def _json(self, **items):
+        """Returns a dict with the format information (if any) and items"""
+        obj = dict()
+        fmt = self._transform_format_json()
+        if fmt:
+            obj["format"] = fmt
+        obj.update(items)
+        return obj
+
     def _apply_format_hook(self, hook):
         if hook:
             self.contentFirst = hook.contentFirst
@@ -817,16 +1979,49 @@ class ContainerBox(Box):
     def append(self, node):
         self.resourceNodes.append(node)
 
+    def extend(self, nodes):
+        """Appends all nodes, for example the ones returned by
+        Context.instancesOf() or Context.lensDomain()"""
+        self.resourceNodes.extend(nodes)
+
+    @_phase("select")
     def select(self):
+        self.context.prefetch(self.resourceNodes)
         for n in self.resourceNodes:
             newctx = self.context.clone()
-            self.resources.append(ResourceBox(newctx, n))
-            self.resources[-1].select()
+            self.resources.append(newctx.selectBox(ResourceBox, n))
 
+    @_phase("portray")
     def portray(self):
         # TODO: Formatting the Container Box
         for n in self.resources: n.portray()
 
+    def children(self):
+        return self.resources
+
+    def update(self, added=(), removed=()):
+        """Brings the selected and portrayed boxes up to date after
+        the triples in added have been added to the instance graph and
+        the ones in removed (which may be patterns) have been removed
+
+        Only the ResourceBoxes which read triples of the changed
+        subjects, or the classes in their type closures, are selected
+        and portrayed again, along with their contents. The others
+        are left alone. This requires the boxes to have been selected
+        in a context with dependencies, otherwise all of them are
+        selected again. Afterwards, transform() reflects the changes.
+        The caches of the context are invalidated as needed."""
+        changed = {s for (s, _, _) in itertools.chain(added, removed)}
+        if None in changed:
+            changed = None
+        self.context.typeCache.invalidate(changed)
+        self.context.selectorResults.clear()
+        if self.context.memo is not None:
+            self.context.memo.clear()
+        for (i, box) in enumerate(self.resources):
+            self.resources[i] = box.update(self.context.clone(), changed)
+
+    @_phase("transform")
     def transform(self):
         return etree.ElementTree(
             E.fresnelresult(
@@ -835,13 +2030,268 @@ class ContainerBox(Box):
             )
         )
 
+    @_phase("transform")
+    def transformJson(self):
+        """Returns the same information as transform(), but made of
+        dicts, lists and strings, ready for json.dumps()"""
+        return self._json(resources=[r.transformJson() for r in self.resources])
+
+    def renderIncrementally(self):
+        """Selects, portrays and transforms one resource after the other
+
+        This is a generator yielding the resource element of every
+        node in resourceNodes as soon as it is finished. Use it instead
+        of select(), portray() and transform(). The ResourceBoxes are
+        not kept in resources, so memory is bounded by the largest
+        resource rather than by all of them (unless the context has a
+        memo, which keeps all boxes)."""
+        for box in self._renderResources():
+            yield self._serialize(None, box)
+
+    def _renderResources(self):
+        self._prefetch(self.resourceNodes)
+        for n in self.resourceNodes:
+            box = self._selectResource(self.context.clone(), n)
+            self._portrayResource(box)
+            yield box
+
+    # The steps of rendering a single resource, timed by the profiler
+
+    @_phase("select")
+    def _prefetch(self, nodes):
+        self.context.prefetch(nodes)
+
+    @_phase("select")
+    def _selectResource(self, context, node):
+        return context.selectBox(ResourceBox, node)
+
+    @_phase("portray")
+    def _portrayResource(self, box):
+        box.portray()
+
+    @_phase("transform")
+    def _serialize(self, output, box):
+        """Returns box serialized as output (see _serializers), or
+        transformed, if output is None"""
+        return _serializers[output](box) if output else box.transform()
+
+    def renderCached(self, output="xml"):
+        """Like renderIncrementally(), but yields the serialized resource
+        elements and takes them from the fragmentCache of the context
+        where possible
+
+        output is the name of the serialization, see _serializers.
+        Resources which are not in the cache are rendered with a fresh
+        memo each, so that all the nodes they depend on are
+        recorded."""
+        cache = self.context.fragmentCache
+        version = cache.version
+        keys = [(output, self.context.clone().boxKey(ResourceBox, n)) for n in self.resourceNodes]
+        fragments = [cache.get(key) for key in keys]
+        self._prefetch([n for (n, f) in zip(self.resourceNodes, fragments) if f is None])
+        for (n, key, fragment) in zip(self.resourceNodes, keys, fragments):
+            if fragment is None:
+                newctx = self.context.clone(dependencies=set(),
+                    memo=dict() if self.context.memo is not None else None)
+                box = self._selectResource(newctx, n)
+                self._portrayResource(box)
+                fragment = self._serialize(output, box)
+                if not (self.context.budget and self.context.budget.truncated):
+                    cache.put(key, fragment, frozenset(box.allDependencies()), version)
+            yield fragment
+
+    def renderParallel(self, jobs, chunksize=1, output="xml"):
+        """Renders the resources in jobs worker processes
+
+        This is a generator yielding every resource element, already
+        serialized as by write() (or writeJson(), if output is
+        "json"), in the order of resourceNodes. Like
+        renderIncrementally(), it replaces select(), portray() and
+        transform().
+
+        Where possible, the workers are forked, so they share the
+        graphs and the FresnelCache of the context with this process
+        instead of receiving copies. Otherwise, the context is pickled
+        once per worker. Each worker has its own copy of the caches of
+        the context, and of its budget."""
+        global _workerContext
+        self.context.prefetch(self.resourceNodes)
+        if "fork" in multiprocessing.get_all_start_methods():
+            _workerContext = self.context
+            pool = multiprocessing.get_context("fork").Pool(jobs)
+        else:
+            pool = multiprocessing.Pool(jobs, _initWorker, (self.context,))
+        try:
+            yield from pool.imap(functools.partial(_renderInWorker, output=output),
+                                 self.resourceNodes, chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+            _workerContext = None
+
+    def write(self, f, free=False, incremental=False, jobs=None):
+        """Transforms the resources and writes the XML document to f
+
+        f must be a binary file-like object. The output is the same as
+        the serialization of transform(), but the XML tree of only one
+        resource is held in memory at a time. If free is True, every
+        ResourceBox is dropped from resources as soon as it has been
+        written.
+
+        If incremental is True, resources are rendered by
+        renderIncrementally() (or by renderCached(), if the context has
+        a fragmentCache) while they are written, so select() and
+        portray() must not be called before. If jobs is given, they
+        are rendered by renderParallel() with that many processes."""
+        f.writelines(self._document("xml", self._serializedResources("xml", free, incremental, jobs)))
+
+    def writeJson(self, f, free=False, incremental=False, jobs=None):
+        """Writes the resources to f as compact JSON
+
+        The document is the serialization of transformJson(). It is
+        written resource by resource without building any XML. The
+        arguments are the same as for write()."""
+        f.writelines(self._document("json", self._serializedResources("json", free, incremental, jobs)))
+
+    def writeDelimited(self, f, output="xml", jobs=None):
+        """Renders the resources like write(f, incremental=True) (or
+        writeJson()) and writes the document as a single line, ended by
+        a newline
+
+        Newlines in the XML document are written as &#10;, which does
+        not change its meaning except within comments and processing
+        instructions. JSON documents contain no newlines anyway."""
+        for piece in self._document(output, self._serializedResources(output, False, True, jobs)):
+            if piece is _xmlDeclaration:
+                piece = piece.rstrip()
+            f.write(piece.replace(b"\n", b"&#10;"))
+        f.write(b"\n")
+
+    def writeFiles(self, directory, output="xml", jobs=None, fileName=None, pipeline=None):
+        """Renders the resources like write(f, incremental=True) and
+        writes each one as a document of its own to a file in directory
+
+        output is "xml" or "json". fileName is a function returning the
+        name of the file for a node, resourceFileName() by default. If
+        pipeline (see RDFFresnel.xslt.Pipeline) is given, it is applied
+        to every XML document. Returns the paths of the files in the
+        order of resourceNodes."""
+        if fileName is None:
+            fileName = functools.partial(resourceFileName, extension="." + output)
+        if pipeline is not None:
+            documents = ((bytes(pipeline.apply(etree.ElementTree(
+                              E.fresnelresult(self._transform_format(), element)))),)
+                         for element in self.renderIncrementally())
+        else:
+            documents = (self._document(output, (part,))
+                         for part in self._serializedResources(output, False, True, jobs))
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for (node, document) in zip(self.resourceNodes, documents):
+            path = os.path.join(directory, fileName(node))
+            with open(path, "wb") as f:
+                f.writelines(document)
+            paths.append(path)
+        return paths
+
+    def _document(self, output, parts):
+        """Yields the pieces of the document made of the serialized
+        resources parts, see _serializers"""
+        if output == "xml":
+            (head, tail) = self._xmlEnvelope()
+            yield _xmlDeclaration
+            yield head
+            yield from parts
+            yield tail
+        else:
+            fmt = self._transform_format_json()
+            yield b'{"format":' + _jsonBytes(fmt) + b',"resources":[' if fmt else b'{"resources":['
+            for (i, part) in enumerate(parts):
+                yield b"," + part if i else part
+            yield b"]}"
+
+    def _serializedResources(self, output, free, incremental, jobs):
+        if jobs:
+            return self.renderParallel(jobs, output=output)
+        if incremental and self.context.fragmentCache is not None:
+            return self.renderCached(output)
+        boxes = self._renderResources() if incremental else self._keptResources(free)
+        return map(functools.partial(self._serialize, output), boxes)
+
+    def _keptResources(self, free):
+        for i in range(len(self.resources)):
+            yield self.resources[i]
+            if free:
+                self.resources[i] = None
+        if free:
+            self.resources = []
+
+    def _xmlEnvelope(self):
+        """Returns the serialized fresnelresult element, split into the
+        part before and the part after the resources"""
+        root = E.fresnelresult(self._transform_format(), etree.Comment("rdffresnel-split"))
+        (head, tail) = etree.tostring(root, encoding="UTF-8").split(_xmlSplitMark)
+        return (head, tail)
+
+    @staticmethod
+    def _xmlResource(element):
+        """Serializes a resource element as a child of fresnelresult,
+        that is, without declaring the namespace again"""
+        return etree.tostring(element, encoding="UTF-8").replace(_xmlnsDeclaration, b"", 1)
+
     def __str__(self):
         return "ContainerBox\n" + \
             self._str_indent(self._str_fmt()) + "\n" + \
             self._str_indent("\n".join((str(r) for r in self.resources)))
 
+# Context of the worker processes of ContainerBox.renderParallel()
+_workerContext = None
+
+def _initWorker(context):
+    global _workerContext
+    _workerContext = context
+
+def _renderInWorker(node, output):
+    box = _workerContext.clone().selectBox(ResourceBox, node)
+    box.portray()
+    return _serializers[output](box)
+
+def containerChunks(context, nodes, size):
+    """Yields ContainerBoxes holding up to size of the nodes each
+
+    nodes may be any iterable, which is consumed one chunk at a time.
+    Every container gets a context of its own from
+    context.newRendering(), so the caches of one chunk are dropped
+    when the next one starts and memory does not grow with the
+    number of nodes."""
+    nodes = iter(nodes)
+    while True:
+        chunk = list(itertools.islice(nodes, size))
+        if not chunk:
+            return
+        box = ContainerBox(context.newRendering())
+        box.extend(chunk)
+        yield box
+
+def resourceFileName(node, extension=""):
+    """Returns a file name for node: its URI, percent-encoded, or a
+    hash of it, if that is too long"""
+    name = urllib.parse.quote(str(node), safe="")
+    if len(name) + len(extension) > 200:
+        name = hashlib.sha1(str(node).encode("UTF-8")).hexdigest()
+    return name + extension
+
+def _jsonBytes(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("UTF-8")
+
+# Serializations of a portrayed ResourceBox, as used by ContainerBox
+_serializers = {
+    "xml": lambda box: ContainerBox._xmlResource(box.transform()),
+    "json": lambda box: _jsonBytes(box.transformJson()),
+}
+
 class ResourceBox(Box):
-    __slots__ = ("resourceNode", "label", "properties", "lens")
+    __slots__ = ("resourceNode", "label", "properties", "lens", "portrayed", "reference")
 
     def __init__(self, context, resourceNode):
         super().__init__(context)
@@ -851,8 +2301,25 @@ class ResourceBox(Box):
         self.label = None
         self.properties = []
         self.lens = None
+        self.portrayed = False
+        self.reference = False
+
+    def share(self, context):
+        """A selected ResourceBox does not depend on its parent and can
+        be shared, see Context.selectBox()"""
+        return self
 
     def select(self):
+        self._recordDependencies()
+        if self.context.exhausted():
+            return
+        if self.context.revisited(self.resourceNode):
+            if self.context.cyclePolicy == "reference":
+                self.reference = True
+                return
+            # Stop recursion as if depth was exhausted
+            self.context.depth = 0
+        self.context.path += (self.resourceNode,)
         if self.context.depth > 0:
             # Find a lens for this resource
             self.lens = self.context.lens()
@@ -864,22 +2331,58 @@ class ResourceBox(Box):
         # Create a LabelBox (which will find a lens on its own)
         # (We add a label box to the resource box. This is not part of
         # the specification.)
-        if not self.context.label:
-            self.label = LabelBox(self.context.clone(lensCandidates=None), self.resourceNode)
-            self.label.select()
+        if not self.context.label and not self.context.exhausted():
+            self.label = self.context.clone(lensCandidates=None, label=True).selectBox(LabelBox, self.resourceNode)
 
     def portray(self):
+        if self.portrayed:
+            # This box is shared and has already been portrayed
+            return
+        self.portrayed = True
         self.fmt = self.context.fmt()
         if self.fmt:
             self.style = self.fmt.resourceStyle
             self._apply_format_hook(self.fmt.resourceFormat)
         for p in self.properties: p.portray()
 
+    def children(self):
+        return ([self.label] if self.label else []) + list(self.properties)
+
+    def affectedBy(self, changed):
+        """Tells whether selecting or portraying this box again may
+        give a different result (not counting the ResourceBoxes within
+        it) if triples with a subject in changed (any, if changed is
+        None) have changed"""
+        if self.dependencies is None or changed is None:
+            return True
+        # Labels may be shared by other boxes and record on their own
+        labels = [self.label] + [p.label for p in self.properties]
+        for deps in [self.dependencies] + [l.dependencies for l in labels if l and l.dependencies is not None]:
+            if (None in deps and changed) or not deps.isdisjoint(changed):
+                return True
+        return False
+
+    def update(self, context, changed):
+        """Returns this box, or a new one if it is affectedBy(changed)
+
+        context must be a fresh clone of the context the box has been
+        selected with. The new box is selected and portrayed with
+        it. See ContainerBox.update()."""
+        if self.affectedBy(changed):
+            box = context.selectBox(ResourceBox, self.resourceNode)
+            box.portray()
+            return box
+        for box in self.children():
+            box.update(changed)
+        return self
+
     def transform(self):
         attributes = {}
         attributes["uri"] = self.resourceNode
         if self.lens:
             attributes["lens"] = self.lens.node
+        if self.reference:
+            attributes["reference"] = "true"
         return E.resource(
             self._transform_format(),
             self.label.transform() if self.label else "",
@@ -887,6 +2390,18 @@ class ResourceBox(Box):
             **attributes
         )
 
+    def transformJson(self):
+        obj = {"uri": str(self.resourceNode)}
+        if self.lens:
+            obj["lens"] = str(self.lens.node)
+        if self.reference:
+            obj["reference"] = True
+        obj.update(self._json())
+        if self.label:
+            obj["label"] = self.label.transformJson()
+        obj["properties"] = [p.transformJson() for p in self.properties]
+        return obj
+
     def __str__(self):
         return "ResourceBox\n" + \
             self._str_indent(self._str_fmt()) + "\n" + \
@@ -918,6 +2433,8 @@ class PropertyBox(Box):
         self.values = []
 
     def select(self):
+        if self.context.exhausted():
+            return
         # For every node in valueNodes create a ValueBox
         newctx = self.context.clone()
         if self.propertyDescription.depth and newctx.depth > self.propertyDescription.depth:
@@ -936,19 +2453,22 @@ class PropertyBox(Box):
         if (langs):
             chosen = self.context.picklang(langs)
             self.valueNodes = [v for v in self.valueNodes if (not isinstance(v, Literal)) or v.language == chosen]
-        # Constructing value boxes
-        self.values = [ValueBox(newctx.clone(), v) for v in self.valueNodes]
-        # Call select
-        for v in self.values:
-            v.select()
+        # Constructing value boxes and calling select. Values are
+        # dropped once the budget is exhausted.
+        newctx.prefetch(self.valueNodes)
+        self.values = []
+        for v in self.valueNodes:
+            if newctx.exhausted():
+                break
+            self.values.append(ValueBox(newctx.clone(), v))
+            self.values[-1].select()
         # create a LabelBox (which will find a lens on its own), but
         # do not create one if we are already inside a label.
         # If there is no manual label and no reference property, we
         # can not put a label.
         labelNode = self.propertyDescription.label or self.referenceProperty
-        if (not self.context.label) and labelNode:
-            self.label = LabelBox(self.context.clone(label=True), labelNode)
-            self.label.select()
+        if (not self.context.label) and labelNode and not self.context.exhausted():
+            self.label = self.context.clone(label=True).selectBox(LabelBox, labelNode)
 
     def portray(self):
         if self.referenceProperty:
@@ -967,6 +2487,13 @@ class PropertyBox(Box):
         if self.label: self.label.portray(self.fmt)
         for v in self.values: v.portray(self.fmt)
 
+    def children(self):
+        return ([self.label] if self.label else []) + self.values
+
+    def update(self, changed):
+        for box in self.children():
+            box.update(changed)
+
     def transform(self):
         uri_attr = self.referenceProperty
         return E.property(
@@ -976,6 +2503,14 @@ class PropertyBox(Box):
             **({"uri": str(uri_attr)} if uri_attr else {})
         )
 
+    def transformJson(self):
+        obj = {"uri": str(self.referenceProperty)} if self.referenceProperty else {}
+        obj.update(self._json())
+        if self.label:
+            obj["label"] = self.label.transformJson()
+        obj["values"] = [v.transformJson() for v in self.values]
+        return obj
+
     def __str__(self):
         return "PropertyBox\n" + \
             self._str_indent(self._str_fmt()) + "\n" + \
@@ -993,12 +2528,24 @@ class LabelBox(Box):
         self.context.label = True
         self.context.baseNode = self.node
 
+    def share(self, context):
+        """Returns a LabelBox which shares the selected properties with
+        this one, see Context.selectBox(). The LabelBox itself can not
+        be shared, since it is portrayed with the format of its
+        parent."""
+        box = LabelBox(context, self.node)
+        box.lens = self.lens
+        box.properties = self.properties
+        box.dependencies = self.dependencies
+        return box
+
     @property
     def isManual(self):
         return isinstance(self.node, Literal)
 
     def select(self):
-        if self.isManual:
+        self._recordDependencies()
+        if self.isManual or self.context.exhausted():
             pass
         else:
             # Find a lens for this resource
@@ -1019,6 +2566,13 @@ class LabelBox(Box):
             self._apply_format_hook(self.fmt.labelFormat)
         for p in self.properties: p.portray()
 
+    def children(self):
+        return list(self.properties)
+
+    def update(self, changed):
+        for box in self.children():
+            box.update(changed)
+
     def transform(self):
         if self.isManual:
             return E.label(
@@ -1033,6 +2587,13 @@ class LabelBox(Box):
                 **attributes
             )
 
+    def transformJson(self):
+        if self.isManual:
+            return self._json(text=str(self.node))
+        obj = {"lens": str(self.lens.node)} if self.lens else {}
+        obj.update(self._json(properties=[p.transformJson() for p in self.properties]))
+        return obj
+
     def __str__(self):
         return "LabelBox\n" + \
             self._str_indent(self._str_fmt()) + "\n" + \
@@ -1053,8 +2614,7 @@ class ValueBox(Box):
         if isinstance(self.valueNode, Literal):
             self.content = self.valueNode            
         else:
-            self.content = ResourceBox(self.context.clone(), self.valueNode)
-            self.content.select()
+            self.content = self.context.clone().selectBox(ResourceBox, self.valueNode)
 
     def portray(self, fmt):
         """Formatting stage
@@ -1067,6 +2627,13 @@ class ValueBox(Box):
         if isinstance(self.content, Box):
             self.content.portray()
 
+    def children(self):
+        return [self.content] if isinstance(self.content, Box) else []
+
+    def update(self, changed):
+        if isinstance(self.content, Box):
+            self.content = self.content.update(self.context.clone(), changed)
+
     def transform(self):
         if isinstance(self.content, Box):
             return E.value(
@@ -1094,6 +2661,22 @@ class ValueBox(Box):
                 **litinfo
             )
 
+    def transformJson(self):
+        if isinstance(self.content, Box):
+            return self._json(type="resource", resource=self.content.transformJson())
+        obj = {"type": "literal"}
+        if self.content.language: obj["lang"] = self.content.language
+        if self.content.datatype: obj["datatype"] = str(self.content.datatype)
+        obj.update(self._json())
+        if (self.fmt and
+           ((self.fmt.value == sempfres.parsedForcefullyAsXML) or
+           (self.fmt.value == sempfres.parsed and self.content.datatype == rdf.XMLLiteral))):
+            # Markup, which transform() parses
+            obj["xml"] = str(self.content)
+        else:
+            obj["literal"] = str(self.content)
+        return obj
+
     def __str__(self):
         return "ValueBox\n" + \
             self._str_indent(self._str_fmt()) + "\n" + \
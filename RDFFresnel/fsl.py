@@ -0,0 +1,318 @@
+"""Fresnel Selector Language
+
+An FSL expression is parsed once by parse() into a tree of the classes
+below, which is then evaluated against any number of graphs and
+nodes. Evaluation walks the graph with objects(), subjects() and
+friends, so it needs no query engine. The supported grammar is
+
+    expr  ::= and ( "or" and )*
+    and   ::= path ( "and" path )*
+    path  ::= step ( "/" step )*
+    step  ::= ( "in::" | "out::" )? test ( "[" expr "]" )*
+    test  ::= "*" | QName | <URI> | "literal" | text()
+
+The steps of a path alternate between node steps and arc steps.
+Depending on where the expression is used, it starts with a node step
+(lens and format domains) or with an arc step (showProperties,
+property domains). A node step tests the type of a resource (with a
+class as test), the value of a literal ("literal"), whether the node
+is a literal (text()) or nothing (*). An arc step follows the
+arcs with the given property (or all arcs, with *) outwards or,
+with in::, backwards. The expression in a predicate [...] is evaluated
+from the node or arc it is attached to, starting with an arc step
+after a node step and with a node step after an arc step. The step
+is kept if the predicate selects anything.
+
+showProperties selects the arcs the expression yields, evaluated from
+the resource (see Expression.select()). A lens or format domain
+selects the nodes of the last step of its paths, wherever the first
+step starts, so it is evaluated backwards from the node in question
+(see Path.selectsNode()).
+
+Positional predicates and the other parts of XPath are not
+supported.
+"""
+
+import re
+import itertools
+
+from rdflib import URIRef, BNode, Literal
+
+class FSLError(Exception):
+    pass
+
+_token = re.compile(r"""\s*(?:
+      (?P<uri><[^>]*>)
+    | (?P<literal>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<text>text\(\))
+    | (?P<axis>(?:in|out)::)
+    | (?P<op>[/\[\]*])
+    | (?P<qname>[A-Za-z_][\w.-]*:[\w-]*|:[\w-]*)
+    | (?P<keyword>and\b|or\b)
+    )""", re.X)
+
+def parse(expression, namespaces, arcs=False):
+    """Parses the FSL expression and returns it as Expression
+
+    namespaces maps the prefixes of QNames to namespace URIs. If arcs
+    is True, the paths of the expression start with an arc step,
+    otherwise with a node step. Raises FSLError if the expression is
+    not valid."""
+    return _Parser(expression, namespaces).parse(arcs)
+
+class _Parser:
+    def __init__(self, expression, namespaces):
+        self.namespaces = namespaces
+        self.tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            m = _token.match(expression, pos)
+            if not m:
+                raise FSLError("Unexpected {!r} in FSL expression {!r}".format(expression[pos:].strip()[:10], expression))
+            self.tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+        self.pos = 0
+
+    def parse(self, arcs):
+        expression = self.expr(arcs)
+        if self.pos < len(self.tokens):
+            raise FSLError("Unexpected {!r}".format(self.tokens[self.pos][1]))
+        return expression
+
+    def peek(self, kind, value=None):
+        if self.pos < len(self.tokens):
+            (k, v) = self.tokens[self.pos]
+            return k == kind and (value is None or v == value)
+        return False
+
+    def accept(self, kind, value=None):
+        if self.peek(kind, value):
+            self.pos += 1
+            return self.tokens[self.pos-1][1]
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.tokens[self.pos][1] if self.pos < len(self.tokens) else "end of expression"
+            raise FSLError("Expected {}, found {!r}".format(value or kind, found))
+        return token
+
+    def expr(self, arcs):
+        parts = [self.andExpr(arcs)]
+        while self.accept("keyword", "or"):
+            parts.append(self.andExpr(arcs))
+        return Or(parts) if len(parts) > 1 else parts[0]
+
+    def andExpr(self, arcs):
+        parts = [self.path(arcs)]
+        while self.accept("keyword", "and"):
+            parts.append(self.path(arcs))
+        return And(parts) if len(parts) > 1 else parts[0]
+
+    def path(self, arcs):
+        steps = [self.step(arcs)]
+        while self.accept("op", "/"):
+            arcs = not arcs
+            steps.append(self.step(arcs))
+        return Path(steps)
+
+    def step(self, arcs):
+        axis = self.accept("axis")
+        if axis and not arcs:
+            raise FSLError("Axis {} in a node step".format(axis))
+        if self.accept("op", "*"):
+            (kind, test) = ("any", None)
+        elif self.peek("uri"):
+            (kind, test) = ("type", URIRef(self.expect("uri")[1:-1]))
+        elif self.peek("qname"):
+            (kind, test) = ("type", self.qname(self.expect("qname")))
+        elif not arcs and self.peek("literal"):
+            value = self.expect("literal")[1:-1]
+            (kind, test) = ("literal", re.sub(r"\\(.)", r"\1", value))
+        elif not arcs and self.accept("text"):
+            (kind, test) = ("text", None)
+        else:
+            self.expect("step")
+        predicates = []
+        while self.accept("op", "["):
+            predicates.append(self.expr(not arcs))
+            self.expect("op", "]")
+        if arcs:
+            return ArcStep(test, axis == "in::", predicates)
+        return NodeStep(kind, test, predicates)
+
+    def qname(self, token):
+        (prefix, local) = token.split(":", 1)
+        if prefix not in self.namespaces:
+            raise FSLError("Unknown prefix {}".format(prefix))
+        return URIRef(self.namespaces[prefix] + local)
+
+class Expression:
+    """A parsed FSL expression
+
+    Expressions are evaluated on a list of (property, node) pairs, the
+    property being the one of the last arc step (or None), and return
+    such a list of the pairs they select, without duplicates. Or, And
+    and Path implement evaluate(graph, items, types) for this, and
+    selectsNode(), isPropertyTest() and matchesProperty(), see Path."""
+
+    __slots__ = ()
+
+    def select(self, graph, node, types):
+        """Evaluates the expression starting from node and returns the
+        selected (property, node) pairs
+
+        types is a function returning the set of classes of a node."""
+        return self.evaluate(graph, [(None, node)], types)
+
+class Or(Expression):
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def evaluate(self, graph, items, types):
+        return list(dict.fromkeys(itertools.chain(*[p.evaluate(graph, items, types) for p in self.parts])))
+
+    def matchesProperty(self, propertyNode):
+        return any(p.matchesProperty(propertyNode) for p in self.parts)
+
+    def isPropertyTest(self):
+        return all(p.isPropertyTest() for p in self.parts)
+
+    def selectsNode(self, graph, node, types):
+        return any(p.selectsNode(graph, node, types) for p in self.parts)
+
+class And(Expression):
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def evaluate(self, graph, items, types):
+        results = []
+        for p in self.parts:
+            result = p.evaluate(graph, items, types)
+            if not result:
+                return []
+            results.append(result)
+        return list(dict.fromkeys(itertools.chain(*results)))
+
+    def matchesProperty(self, propertyNode):
+        return all(p.matchesProperty(propertyNode) for p in self.parts)
+
+    def isPropertyTest(self):
+        return all(p.isPropertyTest() for p in self.parts)
+
+    def selectsNode(self, graph, node, types):
+        return all(p.selectsNode(graph, node, types) for p in self.parts)
+
+class Path(Expression):
+    __slots__ = ("steps",)
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def evaluate(self, graph, items, types):
+        for step in self.steps:
+            items = step.evaluate(graph, items, types)
+            if not items:
+                break
+        return items
+
+    def matchesProperty(self, propertyNode):
+        """Tells whether the expression, which must start with an arc
+        step, selects the property propertyNode. Only expressions for
+        which isPropertyTest() is True can be checked this way."""
+        if not self.isPropertyTest():
+            raise FSLError("Only a single arc step can select a property")
+        return self.steps[0].test in (None, propertyNode)
+
+    def selectsNode(self, graph, node, types):
+        """Tells whether node is among the nodes selected by the last
+        step of the path, starting from any node
+
+        The steps are walked backwards from node, following each arc
+        step against its direction. Predicates are evaluated forwards
+        from the node or arc they are attached to."""
+        items = [(None, node)]
+        for step in reversed(self.steps):
+            items = step.evaluateBackwards(graph, items, types)
+            if not items:
+                return False
+        return True
+
+    def isPropertyTest(self):
+        """Tells whether the expression only consists of single
+        outward arc steps without predicates, which only depend on the
+        property and not on the graph"""
+        return len(self.steps) == 1 and isinstance(self.steps[0], ArcStep) \
+            and not self.steps[0].inverse and not self.steps[0].predicates
+
+class NodeStep:
+    __slots__ = ("kind", "test", "predicates")
+
+    def __init__(self, kind, test, predicates):
+        self.kind = kind
+        self.test = test
+        self.predicates = predicates
+
+    def accepts(self, node, types):
+        if self.kind == "any":
+            return True
+        if self.kind == "type":
+            return isinstance(node, (URIRef, BNode)) and self.test in types(node)
+        if self.kind == "literal":
+            return isinstance(node, Literal) and str(node) == self.test
+        return isinstance(node, Literal)
+
+    def evaluate(self, graph, items, types):
+        return [(p, n) for (p, n) in items
+                if self.accepts(n, types) and
+                   all(pred.evaluate(graph, [(p, n)], types) for pred in self.predicates)]
+
+    evaluateBackwards = evaluate
+
+class ArcStep:
+    __slots__ = ("test", "inverse", "predicates")
+
+    def __init__(self, test, inverse, predicates):
+        self.test = test
+        self.inverse = inverse
+        self.predicates = predicates
+
+    def arcs(self, graph, node, inverse=False):
+        """Yields the (property, node) pairs of the arcs the step
+        follows from node, against their direction if inverse is
+        True"""
+        if self.inverse != inverse:
+            if self.test is not None:
+                return ((self.test, s) for s in graph.subjects(self.test, node))
+            return ((p, s) for (s, p) in graph.subject_predicates(node))
+        if isinstance(node, Literal):
+            return ()
+        if self.test is not None:
+            return ((self.test, o) for o in graph.objects(node, self.test))
+        return graph.predicate_objects(node)
+
+    def evaluate(self, graph, items, types):
+        selected = dict()
+        for (_, n) in items:
+            for arc in self.arcs(graph, n):
+                if arc not in selected and \
+                   all(pred.evaluate(graph, [arc], types) for pred in self.predicates):
+                    selected[arc] = None
+        return list(selected)
+
+    def evaluateBackwards(self, graph, items, types):
+        """Returns the nodes from which the step leads to the nodes of
+        items"""
+        selected = dict()
+        for (_, n) in items:
+            for (p, m) in self.arcs(graph, n, inverse=True):
+                if (None, m) not in selected and \
+                   all(pred.evaluate(graph, [(p, n)], types) for pred in self.predicates):
+                    selected[(None, m)] = None
+        return list(selected)
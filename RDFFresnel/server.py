@@ -0,0 +1,171 @@
+"""Serving rendered RDF resources over HTTP
+
+A RenderServer keeps the graphs and the compiled lenses of a Context
+and answers any number of render requests with them, so they have to
+be loaded only once. Requests look like
+
+    GET /render?uri=http://example.org/a&uri=http://example.org/b&lang=de
+
+uri:    A resource to be rendered, may be given more than once
+lang:   An acceptable language, in descending order of quality, may be
+        given more than once. If missing, the Accept-Language header
+        is used.
+format: The output format, xml (the default) or json, see
+        RenderServer.formats.
+transform: The name of a shipped XSLT stylesheet to be applied to the
+        XML output, may be given more than once, see RDFFresnel.xslt.
+
+Requests are handled concurrently in threads. The server listens either
+on a TCP port or on a Unix domain socket.
+"""
+
+import io
+import os
+import re
+import stat
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from logging import info, error
+
+from rdflib import URIRef
+
+from . import ContainerBox, FresnelException
+from .xslt import Pipeline, findStylesheet
+
+class BadRequest(ValueError):
+    """Raised by RenderServer.render() for invalid arguments"""
+    pass
+
+class RenderServer:
+    """Renders resources on request, using the graphs and the
+    FresnelCache of context
+
+    formats maps the names of output formats to pairs of a content type
+    and a function which writes a rendered ContainerBox to a binary
+    file."""
+
+    formats = {
+        "xml": ("application/xml", lambda box, f: box.write(f, incremental=True)),
+        "json": ("application/json", lambda box, f: box.writeJson(f, incremental=True)),
+    }
+
+    def __init__(self, context):
+        self.context = context
+
+    def render(self, uris, langs=None, format="xml", transforms=()):
+        """Renders the resources uris and returns a pair of the content
+        type and the serialized result
+
+        transforms are the names of stylesheets applied to the XML
+        output, see RDFFresnel.xslt.Pipeline. Raises BadRequest if
+        format or transforms are not valid."""
+        if format not in self.formats:
+            raise BadRequest("Unknown format {}".format(format))
+        (contentType, write) = self.formats[format]
+        ctx = self.context.newRendering()
+        if langs:
+            ctx.langs = tuple(langs)
+        box = ContainerBox(ctx)
+        for uri in uris:
+            box.append(URIRef(uri))
+        if transforms:
+            if format != "xml":
+                raise BadRequest("Stylesheets can only be applied to xml")
+            for name in transforms:
+                try:
+                    findStylesheet(name)
+                except FresnelException as e:
+                    # The message lists the directories searched,
+                    # which are none of the client's business
+                    info(str(e))
+                    raise BadRequest("Unknown stylesheet {}".format(name))
+            pipeline = Pipeline(transforms)
+            box.select()
+            box.portray()
+            return (contentType, bytes(pipeline.apply(box.transform())))
+        out = io.BytesIO()
+        write(box, out)
+        return (contentType, out.getvalue())
+
+    def handler(self):
+        """Returns a request handler class for http.server"""
+        server = self
+
+        class RenderRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path != "/render":
+                    self.send_error(404)
+                    return
+                query = parse_qs(url.query)
+                uris = query.get("uri", [])
+                langs = query.get("lang") or acceptedLanguages(self.headers.get("Accept-Language", ""))
+                format = query.get("format", ["xml"])[0]
+                transforms = query.get("transform", [])
+                if not uris:
+                    self.send_error(400, "No uri given")
+                    return
+                if not all(re.fullmatch(r"[\w-]+", t) for t in transforms):
+                    # Only shipped stylesheets, no paths
+                    self.send_error(400, "Invalid stylesheet name")
+                    return
+                try:
+                    (contentType, body) = server.render(uris, langs, format, transforms)
+                except BadRequest as e:
+                    self.send_error(400, str(e))
+                    return
+                except Exception as e:
+                    error("Rendering {} failed: {}".format(uris, e))
+                    self.send_error(500, "Rendering failed")
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # Clients of Unix domain sockets have no address
+                return self.client_address[0] if self.client_address else "-"
+
+            def log_message(self, format, *args):
+                info("%s - %s" % (self.address_string(), format % args))
+
+        return RenderRequestHandler
+
+    def serve(self, address=None, socketPath=None):
+        """Serves requests forever
+
+        address:    (host, port) to listen on with TCP
+        socketPath: path of a Unix domain socket to listen on instead"""
+        if socketPath:
+            if os.path.exists(socketPath) and stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                # Left over from an earlier server
+                os.remove(socketPath)
+            httpd = ThreadingUnixHTTPServer(socketPath, self.handler())
+        else:
+            httpd = ThreadingHTTPServer(address, self.handler())
+        with httpd:
+            httpd.serve_forever()
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def acceptedLanguages(header):
+    """Turns an Accept-Language header into a list of languages in
+    descending order of quality"""
+    langs = []
+    for (i, item) in enumerate(header.split(",")):
+        parts = item.strip().split(";")
+        quality = 1.0
+        for param in parts[1:]:
+            (k, _, v) = param.strip().partition("=")
+            if k == "q":
+                try:
+                    quality = float(v)
+                except ValueError:
+                    quality = 0.0
+        if parts[0] and parts[0] != "*" and quality > 0:
+            langs.append((-quality, i, parts[0]))
+    return [l for (_, _, l) in sorted(langs)]
@@ -0,0 +1,72 @@
+"""Instance graphs kept in persistent rdflib stores
+
+Instead of parsing the instance data into memory for every run, it can
+be imported once into a store plugin of rdflib which keeps it on disk
+(like BerkeleyDB, or the ones of packages like rdflib-sqlalchemy) and
+opened from there afterwards:
+
+    graph = openGraph("BerkeleyDB", "/var/lib/data", create=True)
+    importInto(graph, "stuff.rdf")
+    graph.close()
+
+    graph = openGraph("BerkeleyDB", "/var/lib/data")
+    ctx = Context(fresnelGraph=lenses, instanceGraph=graph,
+                  **contextOptions(graph))
+
+Every triple lookup of such a store is a database query, so
+contextOptions() turns on the options of Context which reduce their
+number. Stores which evaluate SPARQL themselves, like SPARQLStore, are
+passed the selectors as queries, see FresnelCache.pushdownStores.
+"""
+
+from rdflib import Graph, Dataset, URIRef, plugin
+from rdflib.store import Store, VALID_STORE
+from rdflib.plugins.stores.memory import Memory, SimpleMemory
+
+from . import FresnelException
+
+defaultIdentifier = URIRef("urn:x-rdflib:default")
+
+def openGraph(store, configuration, identifier=None, create=False):
+    """Opens the store plugin named store and returns a Graph of it
+
+    configuration is passed to the store, it usually is a path or the
+    URL of a database. identifier is the URI of the graph within the
+    store. Without one, the union of all graphs of the store is
+    returned, so data imported by an earlier run is found again. If
+    create is True, the store is created if it does not exist."""
+    try:
+        storeClass = plugin.get(store, Store)
+    except plugin.PluginException:
+        raise FresnelException("Unknown store {}, is the package providing it installed?".format(store))
+    if identifier is not None:
+        graph = Graph(store=storeClass(), identifier=URIRef(identifier))
+    elif storeClass.context_aware:
+        graph = Dataset(store=storeClass(), default_union=True)
+    else:
+        # The store keeps a single graph, its identifier does not matter
+        graph = Graph(store=storeClass(), identifier=defaultIdentifier)
+    try:
+        result = graph.open(configuration, create=create)
+    except Exception as e:
+        raise FresnelException("Can not open store {} at {}: {}".format(store, configuration, e))
+    if result not in (VALID_STORE, None):
+        raise FresnelException("Can not open store {} at {}".format(store, configuration))
+    return graph
+
+def importInto(graph, source, format=None):
+    """Parses the file source into graph and commits, if the store
+    supports transactions"""
+    graph.parse(source, format=format)
+    if graph.store.transaction_aware:
+        graph.commit()
+
+def contextOptions(graph):
+    """Returns the options for Context which suit the store of graph
+
+    For persistent stores, the arcs of a resource are fetched with one
+    lookup (bulkArcs) and SPARQL selectors are evaluated for all
+    siblings at once (batchSelectors)."""
+    if isinstance(graph.store, (Memory, SimpleMemory)):
+        return {}
+    return {"bulkArcs": True, "batchSelectors": True}
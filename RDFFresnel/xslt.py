@@ -0,0 +1,84 @@
+"""Applying XSLT stylesheets in process
+
+Instead of serializing the result of RDFFresnel and running xsltproc on
+it, the stylesheets shipped with this package (or any others) can be
+applied to the tree returned by ContainerBox.transform() directly:
+
+    pipeline = Pipeline(["fresneltoxhtml5", "xhtml5tohtml5"])
+    result = pipeline.apply(box.transform())
+    somefile.write(bytes(result))
+
+Every stylesheet is compiled once into an lxml.etree.XSLT object, which
+is kept for the lifetime of the process and reused by all pipelines.
+The output of the last stylesheet is serialized according to its
+xsl:output element.
+"""
+
+import os
+import sys
+import site
+import threading
+
+from lxml import etree
+
+from . import FresnelException
+
+# Directories in which stylesheets given by name are searched: the
+# source tree and the places setup.py installs them to
+transformDirs = [
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "transforms"),
+    os.path.join(sys.prefix, "share", "RDFFresnel", "transforms"),
+    os.path.join(site.getuserbase(), "share", "RDFFresnel", "transforms"),
+    "/usr/local/share/RDFFresnel/transforms",
+    "/usr/share/RDFFresnel/transforms",
+]
+
+_stylesheets = dict()
+_lock = threading.Lock()
+
+def findStylesheet(name):
+    """Returns the path of the stylesheet name, which is either the
+    name of a shipped stylesheet like fresneltoxhtml5 or a path"""
+    if name.endswith(".xsl") and os.path.exists(name):
+        return os.path.abspath(name)
+    for d in transformDirs:
+        path = os.path.join(d, name + ".xsl")
+        if os.path.exists(path):
+            return path
+    raise FresnelException("Stylesheet {} not found in {}".format(name, ", ".join(transformDirs)))
+
+def stylesheet(name):
+    """Returns the compiled stylesheet name, see findStylesheet()
+
+    It is compiled on first use, and again only if the file has been
+    modified since."""
+    path = findStylesheet(name)
+    mtime = os.stat(path).st_mtime
+    with _lock:
+        if path not in _stylesheets or _stylesheets[path][0] != mtime:
+            try:
+                _stylesheets[path] = (mtime, etree.XSLT(etree.parse(path)))
+            except (etree.XMLSyntaxError, etree.XSLTParseError) as e:
+                raise FresnelException("Can not compile stylesheet {}: {}".format(path, e))
+        return _stylesheets[path][1]
+
+class Pipeline:
+    """A sequence of stylesheets, applied one after the other
+
+    names: the stylesheets, see findStylesheet()"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.stylesheets = [stylesheet(name) for name in self.names]
+
+    def apply(self, tree):
+        """Returns the result of applying all stylesheets to the
+        ElementTree tree. bytes() of it is the serialized output."""
+        for xslt in self.stylesheets:
+            tree = xslt(tree)
+        return tree
+
+    def write(self, tree, f):
+        """Applies the stylesheets to tree and writes the output to the
+        binary file f"""
+        f.write(bytes(self.apply(tree)))
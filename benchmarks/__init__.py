@@ -0,0 +1,13 @@
+"""Benchmarks of RDFFresnel
+
+Run from the root of the source tree:
+
+    python3 -m benchmarks.run --resources 2000 --output results.json
+    python3 -m benchmarks.run --compare results.json
+    python3 -m benchmarks.askselectors --resources 2000
+    python3 -m benchmarks.stores --store BerkeleyDB --resources 5000
+
+benchmarks.generate builds the synthetic instance and fresnel graphs
+the benchmarks run on. They only depend on the parameters and the
+seed, so results of different versions of RDFFresnel are comparable.
+"""
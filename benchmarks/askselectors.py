@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""Compares the evaluation of simple SPARQL ASK selectors by the SPARQL
+engine with their evaluation as triple pattern lookups
+
+    python3 -m benchmarks.askselectors --resources 2000
+"""
+
+import argparse
+import logging
+import time
+
+from rdflib import Graph, Namespace, Literal, RDF
+from RDFFresnel import Context, FresnelCache
+
+ex = Namespace("http://example.org/")
+
+lenses = """
+@prefix fresnel: <http://www.w3.org/2004/09/fresnel#> .
+@prefix ex: <http://example.org/> .
+@prefix : <http://example.org/lenses#> .
+
+:openLens a fresnel:Lens ;
+    fresnel:instanceLensDomain "ASK {{ ?target a ex:Doc ; ex:status \\"open\\" }}"^^fresnel:sparqlSelector ;
+    fresnel:showProperties ( ex:title ) .
+{extra}
+"""
+
+extraLens = """
+:lens{0} a fresnel:Lens ;
+    fresnel:instanceLensDomain "ASK {{ ?target ex:tag \\"t{0}\\" ; ex:author ?a }}"^^fresnel:sparqlSelector ;
+    fresnel:showProperties ( ex:title ) .
+"""
+
+def instances(n):
+    g = Graph()
+    for i in range(n):
+        doc = ex["doc{}".format(i)]
+        g.add((doc, RDF.type, ex.Doc))
+        g.add((doc, ex.status, Literal("open" if i % 2 else "closed")))
+        g.add((doc, ex.tag, Literal("t{}".format(i % 10))))
+        g.add((doc, ex.title, Literal("Document {}".format(i))))
+        g.add((doc, ex.author, ex["person{}".format(i % 50)]))
+    return g
+
+def run(fresnelCache, instanceGraph, native):
+    fresnelCache.nativeSelectors = native
+    ctx = Context(fresnelGraph=fresnelCache.fresnelGraph, fresnelCache=fresnelCache,
+                  instanceGraph=instanceGraph)
+    start = time.perf_counter()
+    chosen = [ctx.clone(baseNode=n).lens() for n in instanceGraph.subjects(RDF.type, ex.Doc)]
+    return (time.perf_counter() - start, [l.node if l else None for l in chosen])
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("--resources", type=int, default=1000)
+    argparser.add_argument("--lenses", type=int, default=10,
+                           help="Number of additional lenses with ASK selectors")
+    args = argparser.parse_args()
+    logging.disable(logging.WARNING)
+
+    fresnelGraph = Graph().parse(data=lenses.format(
+        extra="".join(extraLens.format(i) for i in range(args.lenses))), format="turtle")
+    fresnelCache = FresnelCache(fresnelGraph)
+    instanceGraph = instances(args.resources)
+
+    (engine, engineLenses) = run(fresnelCache, instanceGraph, False)
+    (native, nativeLenses) = run(fresnelCache, instanceGraph, True)
+    assert engineLenses == nativeLenses
+    print("{} resources, {} ASK selectors".format(args.resources, args.lenses + 1))
+    print("SPARQL engine:  {:8.3f} s".format(engine))
+    print("triple lookups: {:8.3f} s".format(native))
+    print("speedup:        {:8.1f}x".format(engine / native))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Synthetic instance graphs and fresnel graphs
+
+The instance graph consists of resources ex:r0, ex:r1, ... which are
+instances of the classes of a class hierarchy and link to each other
+with ex:link. Their lenses and formats are generated for the classes
+of the same hierarchy. The same parameters and seed always give the
+same graphs.
+"""
+
+import random
+
+from rdflib import Graph, Namespace, Literal, BNode, RDF, RDFS
+from rdflib.collection import Collection
+
+fresnel = Namespace("http://www.w3.org/2004/09/fresnel#")
+ex = Namespace("http://example.org/")
+lensNs = Namespace("http://example.org/lenses#")
+
+def classes(depth, branching=2):
+    """Returns the classes of a class hierarchy with depth levels, each
+    class having branching subclasses, as list of (class, superclass)
+    pairs, the root class having superclass None"""
+    hierarchy = [(ex.C, None)]
+    level = [ex.C]
+    for _ in range(depth - 1):
+        level = [ex[c.split("/")[-1] + str(i)] for c in level for i in range(branching)]
+        hierarchy.extend((c, ex[c.split("/")[-1][:-1]]) for c in level)
+    return hierarchy
+
+def instances(resources=1000, fanout=3, cycles=0.1, depth=3, seed=0):
+    """Returns an instance graph
+
+    resources: number of resources
+    fanout:    number of ex:link arcs of every resource
+    cycles:    fraction of the links which point backwards, that is to
+               a resource with a lower number. The others point
+               forwards, so without them the links are acyclic.
+    depth:     number of levels of the class hierarchy, see classes()
+    seed:      seed of the random number generator"""
+    rnd = random.Random(seed)
+    g = Graph()
+    g.bind("ex", ex)
+    hierarchy = classes(depth)
+    for (c, superclass) in hierarchy:
+        if superclass is not None:
+            g.add((c, RDFS.subClassOf, superclass))
+    nodes = [ex["r{}".format(i)] for i in range(resources)]
+    for (i, node) in enumerate(nodes):
+        g.add((node, RDF.type, rnd.choice(hierarchy)[0]))
+        g.add((node, ex.name, Literal("Resource {}".format(i), lang="en")))
+        g.add((node, ex.status, Literal(rnd.choice(("open", "closed")))))
+        if rnd.random() < 0.5:
+            g.add((node, ex.title, Literal("Title {}".format(i))))
+        for _ in range(fanout):
+            backwards = i == resources - 1 or (i > 0 and rnd.random() < cycles)
+            target = rnd.randrange(0, i) if backwards else rnd.randrange(i + 1, resources)
+            g.add((node, ex.link, nodes[target]))
+        g.add((node, rnd.choice((ex.author, ex.editor)), rnd.choice(nodes)))
+    return g
+
+def lenses(count=10, formats=10, depth=3, sparql=0.2, fsl=0.1,
+           sublenses=True, merge=True, sublensDepth=2, seed=0):
+    """Returns a fresnel graph for the instance graphs of instances()
+
+    count:        number of lenses, each for one class of the
+                  hierarchy of the given depth, see classes()
+    formats:      number of formats, half of them class formats and
+                  half of them property formats
+    sparql:       fraction of lenses and formats which have a SPARQL
+                  ASK selector as domain instead of a class
+    fsl:          fraction of lenses which have an FSL selector as
+                  domain instead of a class
+    sublenses:    whether ex:link is shown with another lens as
+                  sublens, up to a depth of sublensDepth
+    merge:        whether lenses show ex:author and ex:editor merged
+                  and ex:title as alternative of the missing
+                  ex:subtitle
+    seed:         seed of the random number generator"""
+    rnd = random.Random(seed)
+    g = Graph()
+    g.bind("fresnel", fresnel)
+    g.bind("ex", ex)
+    hierarchy = [c for (c, _) in classes(depth)]
+    lensNodes = [lensNs["lens{}".format(i)] for i in range(count)]
+    for (i, lens) in enumerate(lensNodes):
+        c = hierarchy[i % len(hierarchy)]
+        g.add((lens, RDF.type, fresnel.Lens))
+        g.add((lens, fresnel.purpose, fresnel.defaultLens))
+        r = rnd.random()
+        if r < sparql:
+            g.add((lens, fresnel.instanceLensDomain, Literal(
+                'ASK {{ ?target a <{}> ; ex:status "open" }}'.format(c),
+                datatype=fresnel.sparqlSelector)))
+        elif r < sparql + fsl:
+            g.add((lens, fresnel.instanceLensDomain, Literal(
+                "ex:{}[ex:status/\"open\"]".format(c.split("/")[-1]),
+                datatype=fresnel.fslSelector)))
+        else:
+            g.add((lens, fresnel.classLensDomain, c))
+        show = [ex.name, ex.status]
+        if sublenses and count > 1:
+            link = lensNs["link{}".format(i)]
+            g.add((link, RDF.type, fresnel.PropertyDescription))
+            g.add((link, fresnel.property, ex.link))
+            g.add((link, fresnel.sublens, rnd.choice(lensNodes)))
+            g.add((link, fresnel.depth, Literal(sublensDepth)))
+            show.append(link)
+        if merge:
+            merged = lensNs["merged{}".format(i)]
+            g.add((merged, RDF.type, fresnel.PropertyDescription))
+            g.add((merged, fresnel.mergeProperties, _list(g, [ex.author, ex.editor])))
+            alternate = lensNs["alternate{}".format(i)]
+            g.add((alternate, RDF.type, fresnel.PropertyDescription))
+            g.add((alternate, fresnel.alternateProperties, _list(g, [ex.subtitle, ex.title])))
+            show.extend((merged, alternate))
+        g.add((lens, fresnel.showProperties, _list(g, show)))
+    for i in range(formats):
+        fmt = lensNs["fmt{}".format(i)]
+        g.add((fmt, RDF.type, fresnel.Format))
+        if i % 2:
+            g.add((fmt, fresnel.propertyFormatDomain,
+                   rnd.choice((ex.name, ex.status, ex.link, ex.title))))
+            g.add((fmt, fresnel.label, Literal("Property {}".format(i))))
+        else:
+            c = rnd.choice(hierarchy)
+            if rnd.random() < sparql:
+                g.add((fmt, fresnel.instanceFormatDomain, Literal(
+                    'ASK {{ ?target a <{}> }}'.format(c),
+                    datatype=fresnel.sparqlSelector)))
+            else:
+                g.add((fmt, fresnel.classFormatDomain, c))
+            g.add((fmt, fresnel.resourceStyle, Literal("s{}".format(i), datatype=fresnel.styleClass)))
+    return g
+
+def _list(g, items):
+    head = BNode()
+    Collection(g, head, items)
+    return head
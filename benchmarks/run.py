@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+"""Times the rendering of synthetic graphs, phase by phase
+
+    python3 -m benchmarks.run --resources 2000 --output results.json
+    python3 -m benchmarks.run --resources 2000 --compare results.json
+
+Every repetition compiles the lenses and renders the resources with a
+new Context, timing each phase: compile (FresnelCache), select,
+portray, transform and serialize. The peak memory is measured with
+tracemalloc in an additional run, since tracing slows rendering down.
+The results are printed and, with --output, written as JSON. With
+--compare, the medians are compared with the ones of an earlier result
+file, and the exit status is 1 if a phase got slower by more than the
+tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import rdflib
+from lxml import etree
+
+from RDFFresnel import Context, ContainerBox, FresnelCache
+from . import generate
+
+phases = ("compile", "select", "portray", "transform", "serialize")
+
+def render(fresnelGraph, instanceGraph, nodes, options):
+    """Renders nodes and returns the seconds every phase took and the
+    number of boxes"""
+    times = dict()
+    start = time.perf_counter()
+    fresnelCache = FresnelCache(fresnelGraph)
+    times["compile"] = time.perf_counter() - start
+    ctx = Context(fresnelGraph=fresnelGraph, instanceGraph=instanceGraph,
+                  fresnelCache=fresnelCache, **options)
+    box = ContainerBox(ctx)
+    for n in nodes:
+        box.append(n)
+    start = time.perf_counter()
+    box.select()
+    times["select"] = time.perf_counter() - start
+    start = time.perf_counter()
+    box.portray()
+    times["portray"] = time.perf_counter() - start
+    start = time.perf_counter()
+    tree = box.transform()
+    times["transform"] = time.perf_counter() - start
+    start = time.perf_counter()
+    etree.tostring(tree, encoding="UTF-8", xml_declaration=True)
+    times["serialize"] = time.perf_counter() - start
+    times["total"] = sum(times.values())
+    return (times, sum(1 for _ in box.walk()))
+
+def peakMemory(fresnelGraph, instanceGraph, nodes, options):
+    """Returns the peak of memory allocated while rendering, in bytes"""
+    tracemalloc.start()
+    try:
+        render(fresnelGraph, instanceGraph, nodes, options)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def revision():
+    """Returns the git revision of the source tree, if available"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, old, tolerance):
+    """Prints the ratios of the medians of results and old and returns
+    whether no phase got slower by more than tolerance"""
+    if results["parameters"] != old["parameters"]:
+        print("Warning: the parameters differ from the ones of the compared results")
+    ok = True
+    print("{:10} {:>10} {:>10} {:>7}".format("phase", "old", "new", "ratio"))
+    for phase in phases + ("total",):
+        (before, after) = (old["times"][phase]["median"], results["times"][phase]["median"])
+        ratio = after / before if before else float("inf")
+        slower = ratio > 1 + tolerance
+        ok = ok and not slower
+        print("{:10} {:10.4f} {:10.4f} {:7.2f}{}".format(
+            phase, before, after, ratio, "  slower" if slower else ""))
+    return ok
+
+def cyclePolicy(value):
+    if value in ("none", "stop", "reference"):
+        return None if value == "none" else value
+    return int(value)
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    group = argparser.add_argument_group("instance graph")
+    group.add_argument("--resources", type=int, default=1000)
+    group.add_argument("--fanout", type=int, default=3)
+    group.add_argument("--cycles", type=float, default=0.1,
+                       help="Fraction of links pointing backwards")
+    group.add_argument("--depth", type=int, default=3,
+                       help="Depth of the class hierarchy")
+    group = argparser.add_argument_group("fresnel graph")
+    group.add_argument("--lenses", type=int, default=10)
+    group.add_argument("--formats", type=int, default=10)
+    group.add_argument("--sparql", type=float, default=0.2,
+                       help="Fraction of lenses and formats with SPARQL selectors")
+    group.add_argument("--fsl", type=float, default=0.1,
+                       help="Fraction of lenses with FSL selectors")
+    group.add_argument("--no-sublenses", action="store_false", dest="sublenses")
+    group.add_argument("--no-merge", action="store_false", dest="merge")
+    group.add_argument("--sublens-depth", type=int, default=2, dest="sublensDepth")
+    group = argparser.add_argument_group("rendering")
+    group.add_argument("--render", type=int,
+                       help="Number of resources to render, all by default")
+    group.add_argument("--batch-selectors", action="store_true", dest="batchSelectors")
+    group.add_argument("--bulk-arcs", action="store_true", dest="bulkArcs")
+    group.add_argument("--cycle-policy", type=cyclePolicy, default=None, dest="cyclePolicy",
+                       help="none, stop, reference or a number")
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--repeat", type=int, default=5)
+    argparser.add_argument("--no-memory", action="store_false", dest="memory",
+                           help="Skip measuring the peak memory")
+    argparser.add_argument("--output", metavar="FILE", help="Write the results as JSON to FILE")
+    argparser.add_argument("--compare", metavar="FILE", help="Compare with the results in FILE")
+    argparser.add_argument("--tolerance", type=float, default=0.1,
+                           help="Allowed slowdown for --compare, 0.1 being 10%%")
+    args = argparser.parse_args()
+    logging.disable(logging.WARNING)
+
+    instanceGraph = generate.instances(args.resources, args.fanout, args.cycles,
+                                       args.depth, args.seed)
+    fresnelGraph = generate.lenses(args.lenses, args.formats, args.depth, args.sparql,
+                                   args.fsl, args.sublenses, args.merge,
+                                   args.sublensDepth, args.seed)
+    nodes = [generate.ex["r{}".format(i)] for i in range(args.render or args.resources)]
+    options = {o: getattr(args, o) for o in ("batchSelectors", "bulkArcs", "cyclePolicy")}
+
+    runs = []
+    for _ in range(args.repeat):
+        (times, boxes) = render(fresnelGraph, instanceGraph, nodes, options)
+        runs.append(times)
+    parameters = {k: v for (k, v) in vars(args).items()
+                  if k not in ("repeat", "memory", "output", "compare", "tolerance")}
+    results = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "rdflib": rdflib.__version__,
+        "parameters": parameters,
+        "triples": {"instances": len(instanceGraph), "lenses": len(fresnelGraph)},
+        "boxes": boxes,
+        "times": {phase: {"min": min(r[phase] for r in runs),
+                          "median": statistics.median(r[phase] for r in runs),
+                          "runs": [r[phase] for r in runs]}
+                  for phase in phases + ("total",)},
+        "peakMemory": peakMemory(fresnelGraph, instanceGraph, nodes, options) if args.memory else None,
+    }
+
+    print("{} resources rendered, {} boxes, {} triples".format(
+        len(nodes), boxes, len(instanceGraph)))
+    for phase in phases + ("total",):
+        print("{:10} {:10.4f} s (min {:.4f} s)".format(
+            phase, results["times"][phase]["median"], results["times"][phase]["min"]))
+    if results["peakMemory"] is not None:
+        print("peak memory {:.1f} MiB".format(results["peakMemory"] / 2**20))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if not compare(results, old, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""Compares rendering from a persistent store with the in-memory path
+
+    python3 -m benchmarks.stores --store BerkeleyDB --resources 5000
+
+The synthetic instance graph (see benchmarks.generate) is written to an
+N-Triples file. The in-memory path parses it into a Graph and renders
+from there. The store path imports it once into the store, opens the
+store again and renders from it, once with the default options of
+Context and once with the ones of RDFFresnel.store.contextOptions().
+If --store-config is not given, the store is created in a temporary
+directory.
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from rdflib import Graph
+
+from RDFFresnel.store import openGraph, importInto, contextOptions
+from . import generate
+from .run import render
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("--store", default="BerkeleyDB")
+    argparser.add_argument("--store-config", dest="storeConfig")
+    argparser.add_argument("--resources", type=int, default=1000)
+    argparser.add_argument("--render", type=int, default=200,
+                           help="Number of resources to render")
+    argparser.add_argument("--lenses", type=int, default=10)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--output", metavar="FILE", help="Write the results as JSON to FILE")
+    args = argparser.parse_args()
+    logging.disable(logging.WARNING)
+
+    fresnelGraph = generate.lenses(args.lenses, seed=args.seed)
+    nodes = [generate.ex["r{}".format(i)] for i in range(min(args.render, args.resources))]
+    results = {"store": args.store, "resources": args.resources, "rendered": len(nodes)}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "instances.nt")
+        generate.instances(args.resources, seed=args.seed).serialize(source, format="nt", encoding="utf-8")
+        config = args.storeConfig or os.path.join(tmp, "store")
+
+        (results["memoryLoad"], graph) = timed(lambda: Graph().parse(source, format="nt"))
+        # Warm up, the first rendering initializes the SPARQL parser
+        render(fresnelGraph, graph, nodes, {})
+        results["memoryRender"] = render(fresnelGraph, graph, nodes, {})[0]["total"]
+
+        graph = openGraph(args.store, config, create=True)
+        (results["storeImport"], _) = timed(importInto, graph, source, "nt")
+        graph.close()
+        (results["storeOpen"], graph) = timed(openGraph, args.store, config)
+        try:
+            if not len(graph):
+                argparser.error("the store {} does not keep its data".format(args.store))
+            results["storeRender"] = render(fresnelGraph, graph, nodes, {})[0]["total"]
+            options = contextOptions(graph)
+            results["storeOptions"] = options
+            results["storeRenderOptimized"] = render(fresnelGraph, graph, nodes, options)[0]["total"]
+        finally:
+            graph.close()
+
+    print("{} resources, {} rendered, store {}".format(args.resources, len(nodes), args.store))
+    print("in memory: load   {:8.3f} s".format(results["memoryLoad"]))
+    print("           render {:8.3f} s".format(results["memoryRender"]))
+    print("store:     import {:8.3f} s (once)".format(results["storeImport"]))
+    print("           open   {:8.3f} s".format(results["storeOpen"]))
+    print("           render {:8.3f} s with default options".format(results["storeRender"]))
+    print("           render {:8.3f} s with {}".format(
+        results["storeRenderOptimized"], results["storeOptions"] or "the same options"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
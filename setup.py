@@ -3,8 +3,8 @@
 import sys
 from distutils.core import setup
 
-if not sys.version_info >= (3,2):
-    print("Error: RDFFresnel requires at least Python 3.2.")
+if not sys.version_info >= (3,8):
+    print("Error: RDFFresnel requires at least Python 3.8.")
     exit(1)
 
 setup(name='RDFFresnel',
@@ -24,7 +24,8 @@ setup(name='RDFFresnel',
                 'transforms/xhtml5toxhtml1.xsl'
             ])
       ],
-      keywords=['Requires: rdflib'],
+      requires=['rdflib (>=6.0)', 'lxml'],
+      keywords=['Requires: rdflib (>=6.0)'],
       classifiers=[
             "Programming Language :: Python :: 3",
             "License :: OSI Approved :: MIT License",
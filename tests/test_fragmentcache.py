@@ -0,0 +1,72 @@
+"""FragmentCache invalidation
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import logging
+import unittest
+
+from rdflib import Graph, Namespace, Literal
+
+from RDFFresnel import Context, ContainerBox, FragmentCache
+
+foaf = Namespace("http://xmlns.com/foaf/0.1/")
+ex = Namespace("http://example.org/")
+
+lenses = """
+@prefix fresnel: <http://www.w3.org/2004/09/fresnel#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix : <http://example.org/lenses#> .
+
+:personLens a fresnel:Lens ;
+    fresnel:classLensDomain foaf:Person ;
+    fresnel:showProperties ( foaf:name ) .
+"""
+
+instances = """
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix ex: <http://example.org/> .
+
+ex:alice a foaf:Person ; foaf:name "Alice" .
+ex:bob a foaf:Person ; foaf:name "Bob" .
+"""
+
+class FragmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.instanceGraph = Graph().parse(data=instances, format="turtle")
+        self.context = Context(fresnelGraph=Graph().parse(data=lenses, format="turtle"),
+                               instanceGraph=self.instanceGraph)
+        self.context.fragmentCache = FragmentCache()
+        self.context.fragmentCache.watch(self.instanceGraph)
+
+    def render(self):
+        box = ContainerBox(self.context.newRendering())
+        box.extend([ex.alice, ex.bob])
+        out = io.BytesIO()
+        box.write(out, incremental=True)
+        return out.getvalue()
+
+    def testAdded(self):
+        self.render()
+        self.instanceGraph.add((ex.alice, foaf.name, Literal("Ally")))
+        self.assertIn(b"Ally", self.render())
+
+    def testRemoved(self):
+        self.assertIn(b"Alice", self.render())
+        self.instanceGraph.remove((ex.alice, foaf.name, None))
+        self.assertNotIn(b"Alice", self.render())
+        self.assertEqual(self.context.fragmentCache.invalidations, 1)
+
+    def testDifferentContexts(self):
+        stop = self.context.clone(cyclePolicy="stop")
+        reference = self.context.clone(cyclePolicy="reference")
+        self.assertNotEqual(stop.boxKey(ContainerBox, ex.alice),
+                            reference.boxKey(ContainerBox, ex.alice))
+        otherGraph = self.context.clone(instanceGraph=Graph())
+        self.assertNotEqual(otherGraph.boxKey(ContainerBox, ex.alice),
+                            self.context.boxKey(ContainerBox, ex.alice))
+
+if __name__ == "__main__":
+    unittest.main()
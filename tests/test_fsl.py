@@ -0,0 +1,140 @@
+"""FSL selectors
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import logging
+import unittest
+
+from rdflib import Graph, Namespace, Literal, RDF
+
+from RDFFresnel import Context, ContainerBox, fsl
+
+foaf = Namespace("http://xmlns.com/foaf/0.1/")
+ex = Namespace("http://example.org/")
+
+namespaces = {"foaf": str(foaf), "ex": str(ex)}
+
+instances = """
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix ex: <http://example.org/> .
+
+ex:alice a foaf:Person ; foaf:name "Alice" ; foaf:knows ex:bob .
+ex:bob a foaf:Person ; foaf:name "Bob" ; foaf:nick "B\\"ob" .
+ex:doc a foaf:Document ; foaf:maker ex:alice .
+"""
+
+lenses = """
+@prefix fresnel: <http://www.w3.org/2004/09/fresnel#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix : <http://example.org/lenses#> .
+
+:knownLens a fresnel:Lens ;
+    fresnel:instanceLensDomain "foaf:Person/foaf:knows/foaf:Person"^^fresnel:fslSelector ;
+    fresnel:showProperties ( "foaf:name or foaf:nick"^^fresnel:fslSelector ) .
+:documentLens a fresnel:Lens ;
+    fresnel:instanceLensDomain "foaf:Document"^^fresnel:fslSelector ;
+    fresnel:showProperties ( "foaf:maker/foaf:Person/foaf:name"^^fresnel:fslSelector ) .
+:nameFormat a fresnel:Format ;
+    fresnel:propertyFormatDomain "foaf:name"^^fresnel:fslSelector ;
+    fresnel:label "Name" .
+:nickFormat a fresnel:Format ;
+    fresnel:propertyFormatDomain "foaf:nick[foaf:Person]"^^fresnel:fslSelector ;
+    fresnel:label "Nick" .
+"""
+
+class FSLTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.graph = Graph().parse(data=instances, format="turtle")
+
+    def types(self, node):
+        return set(self.graph.objects(node, RDF.type))
+
+    def select(self, expression, node, arcs=False):
+        return fsl.parse(expression, namespaces, arcs).select(self.graph, node, self.types)
+
+    def selectsNode(self, expression, node):
+        return fsl.parse(expression, namespaces).selectsNode(self.graph, node, self.types)
+
+    def testTokens(self):
+        self.assertEqual(self.select("<http://xmlns.com/foaf/0.1/Person>", ex.bob), [(None, ex.bob)])
+        self.assertEqual(self.select("foaf:nick/'B\\\"ob'", ex.bob, arcs=True),
+                         [(foaf.nick, Literal('B"ob'))])
+        self.assertEqual(self.select("  foaf:name / text()  ", ex.bob, arcs=True),
+                         [(foaf.name, Literal("Bob"))])
+        self.assertEqual(self.select("out::foaf:knows/*", ex.alice, arcs=True), [(foaf.knows, ex.bob)])
+
+    def testAndOr(self):
+        self.assertEqual(self.select("foaf:name or foaf:knows", ex.alice, arcs=True),
+                         [(foaf.name, Literal("Alice")), (foaf.knows, ex.bob)])
+        self.assertEqual(self.select("foaf:name and foaf:nick", ex.alice, arcs=True), [])
+        self.assertEqual(len(self.select("foaf:name and foaf:nick", ex.bob, arcs=True)), 2)
+
+    def testInverse(self):
+        self.assertEqual(self.select("in::foaf:knows/foaf:Person", ex.bob, arcs=True), [(foaf.knows, ex.alice)])
+        self.assertEqual(self.select("in::foaf:knows", ex.alice, arcs=True), [])
+
+    def testPredicates(self):
+        self.assertEqual(self.select("foaf:Person[foaf:knows]", ex.alice), [(None, ex.alice)])
+        self.assertEqual(self.select("foaf:Person[foaf:knows]", ex.bob), [])
+        self.assertEqual(self.select("foaf:knows[foaf:Person/foaf:name/'Bob']", ex.alice, arcs=True),
+                         [(foaf.knows, ex.bob)])
+        self.assertEqual(self.select("foaf:knows[foaf:Document]", ex.alice, arcs=True), [])
+
+    def testErrors(self):
+        for expression in ["", "foaf:Person foaf:knows", "foaf:Person/", "foaf:Person[foaf:knows", "in::foaf:Person",
+                           "bar:Person", "foaf:Person ]", "foaf:Person or", "#"]:
+            with self.assertRaises(fsl.FSLError, msg=expression):
+                fsl.parse(expression, namespaces)
+
+    def testSelectsNode(self):
+        self.assertTrue(self.selectsNode("foaf:Person/foaf:knows/foaf:Person", ex.bob))
+        self.assertFalse(self.selectsNode("foaf:Person/foaf:knows/foaf:Person", ex.alice))
+        self.assertTrue(self.selectsNode("foaf:Person[foaf:name/'Alice']/foaf:knows/*", ex.bob))
+        self.assertFalse(self.selectsNode("foaf:Person[foaf:name/'Bob']/foaf:knows/*", ex.bob))
+        self.assertFalse(self.selectsNode("foaf:Document/in::foaf:maker/*", ex.alice))
+        self.assertTrue(self.selectsNode("*/in::foaf:maker/foaf:Document", ex.doc))
+        self.assertTrue(self.selectsNode("foaf:Person or foaf:Document", ex.doc))
+        self.assertFalse(self.selectsNode("foaf:Person and foaf:Document", ex.doc))
+
+    def testPropertyTest(self):
+        self.assertTrue(fsl.parse("foaf:name or *", namespaces, True).matchesProperty(foaf.nick))
+        self.assertFalse(fsl.parse("foaf:name", namespaces, True).matchesProperty(foaf.nick))
+        for expression in ["foaf:name/*", "in::foaf:name", "foaf:name[foaf:Person]", "foaf:name or foaf:knows/*"]:
+            self.assertFalse(fsl.parse(expression, namespaces, True).isPropertyTest(), msg=expression)
+
+class FSLRenderingTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.context = Context(fresnelGraph=Graph().parse(data=lenses, format="turtle"),
+                               instanceGraph=Graph().parse(data=instances, format="turtle"))
+
+    def render(self, node):
+        box = ContainerBox(self.context.newRendering())
+        box.append(node)
+        out = io.BytesIO()
+        box.write(out, incremental=True)
+        return out.getvalue()
+
+    def testLensDomain(self):
+        # The domain selects the person known, not the one knowing
+        self.assertIn(b'lens="http://example.org/lenses#knownLens"', self.render(ex.bob))
+        self.assertNotIn(b'lens=', self.render(ex.alice))
+
+    def testShowProperties(self):
+        out = self.render(ex.bob)
+        self.assertIn(b"Bob", out)
+        self.assertIn(b'B"ob', out)
+        self.assertIn(b"Alice", self.render(ex.doc))
+
+    def testPropertyDomain(self):
+        # The predicated domain of nickFormat is reported and never
+        # matches, it does not break the rendering
+        out = self.render(ex.bob)
+        self.assertIn(b"Name", out)
+        self.assertNotIn(b"Nick", out)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""SPARQL selectors evaluated natively, in batches and by the engine
+
+    python3 -m unittest discover tests
+"""
+
+import logging
+import unittest
+
+from rdflib import Graph, Namespace, Literal, BNode
+
+from RDFFresnel import FresnelCache, fresnel
+
+foaf = Namespace("http://xmlns.com/foaf/0.1/")
+ex = Namespace("http://example.org/")
+
+instances = """
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix ex: <http://example.org/> .
+
+ex:alice a foaf:Person ; foaf:name "Alice" ; foaf:knows ex:bob , _:anon .
+ex:bob a foaf:Person ; foaf:name "Bob" ; foaf:nick "B" .
+ex:carol a foaf:Agent ; foaf:name "Carol" ; foaf:knows _:anon .
+ex:doc a foaf:Document .
+_:anon a foaf:Person ; foaf:name "Anon" ; foaf:knows ex:bob .
+"""
+
+def sparql(query):
+    return Literal(query, datatype=fresnel.sparqlSelector)
+
+# Selector and whether it can be evaluated as triple lookups
+selectors = {
+    "bgp": (sparql('ASK { ?target a foaf:Person ; foaf:name ?name }'), True),
+    "literal": (sparql('ASK { ?target foaf:name "Bob" }'), True),
+    "join": (sparql('ASK { ?target foaf:knows ?x . ?x foaf:nick ?nick }'), False),
+    "blankNodeJoin": (sparql('ASK { ?target foaf:knows [ foaf:name "Anon" ] }'), False),
+    "filter": (sparql('ASK { ?target foaf:name ?name FILTER(STRLEN(?name) > 3) }'), False),
+    "optional": (sparql('ASK { ?target foaf:name ?name OPTIONAL { ?target foaf:nick ?nick } '
+                        'FILTER(!BOUND(?nick)) }'), False),
+    "values": (sparql('ASK { VALUES ?type { foaf:Person foaf:Document } ?target a ?type }'), False),
+}
+
+class SelectorTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.instanceGraph = Graph().parse(data=instances, format="turtle")
+        fresnelGraph = Graph()
+        fresnelGraph.bind("foaf", foaf)
+        self.cache = FresnelCache(fresnelGraph)
+        self.anon = self.instanceGraph.value(ex.carol, foaf.knows)
+        self.targets = [ex.alice, ex.bob, ex.carol, ex.doc, self.anon, ex.nobody]
+
+    def engine(self, selector):
+        """The nodes for which the SPARQL engine of rdflib answers true"""
+        return {n for n in self.targets
+                if self.instanceGraph.query(str(selector), initNs={"foaf": foaf},
+                                            initBindings={"target": n}).askAnswer}
+
+    def answers(self, selector, native):
+        self.cache.nativeSelectors = native
+        single = {n for n in self.targets if self.cache.ask(self.instanceGraph, selector, n)}
+        batched = self.cache.askMany(self.instanceGraph, selector, self.targets)
+        return (single, batched)
+
+    def testSelectors(self):
+        for (name, (selector, native)) in selectors.items():
+            with self.subTest(name):
+                expected = self.engine(selector)
+                self.assertTrue(expected, "the selector should match something")
+                self.assertEqual(self.answers(selector, True), (expected, expected))
+                self.assertEqual(self.answers(selector, False), (expected, expected))
+                self.cache.nativeSelectors = True
+                self.assertEqual(self.cache._native(self.instanceGraph, selector) is not None, native)
+
+    def testBlankNodeTargets(self):
+        self.assertIsInstance(self.anon, BNode)
+        for (name, (selector, native)) in selectors.items():
+            with self.subTest(name):
+                self.assertEqual(self.anon in self.engine(selector),
+                                 self.anon in self.answers(selector, False)[1])
+
+    def testOwnValues(self):
+        # The VALUES clause of the selector is not replaced by the
+        # targets of the batch
+        self.cache.prepare(selectors["values"][0])
+        self.assertIsNone(self.cache.batchQueries[selectors["values"][0]])
+        self.cache.prepare(selectors["join"][0])
+        self.assertIsNotNone(self.cache.batchQueries[selectors["join"][0]])
+
+if __name__ == "__main__":
+    unittest.main()
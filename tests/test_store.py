@@ -0,0 +1,98 @@
+"""Instance graphs in stores which keep their data between runs
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import logging
+import os
+import tempfile
+import unittest
+
+from rdflib import Graph, Namespace, plugin
+from rdflib.store import Store
+from rdflib.plugins.stores.memory import Memory
+
+from RDFFresnel import Context, ContainerBox
+from RDFFresnel.store import openGraph, importInto
+
+foaf = Namespace("http://xmlns.com/foaf/0.1/")
+ex = Namespace("http://example.org/")
+
+lenses = """
+@prefix fresnel: <http://www.w3.org/2004/09/fresnel#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix : <http://example.org/lenses#> .
+
+:personLens a fresnel:Lens ;
+    fresnel:instanceLensDomain "ASK { ?target a foaf:Person }"^^fresnel:sparqlSelector ;
+    fresnel:showProperties ( foaf:name ) .
+"""
+
+instances = """
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix ex: <http://example.org/> .
+
+ex:alice a foaf:Person ; foaf:name "Alice" .
+"""
+
+class PersistentMemory(Memory):
+    """Memory store which keeps its triples in a file while closed"""
+    def open(self, configuration, create=False):
+        self.configuration = configuration
+        if os.path.exists(configuration):
+            data = Graph().parse(configuration, format="nt")
+            for (s, p, o) in data:
+                self.add((s, p, o), Graph(self, ex.imported))
+        return super().open(configuration, create)
+
+    def close(self, commit_pending_transaction=False):
+        data = Graph()
+        for ((s, p, o), _) in self.triples((None, None, None)):
+            data.add((s, p, o))
+        data.serialize(self.configuration, format="nt", encoding="utf-8")
+
+plugin.register("PersistentMemory", Store, __name__, "PersistentMemory")
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.directory = tempfile.TemporaryDirectory()
+        self.configuration = os.path.join(self.directory.name, "store.nt")
+        self.source = os.path.join(self.directory.name, "instances.ttl")
+        with open(self.source, "w") as f:
+            f.write(instances)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def render(self, graph, nativeSelectors):
+        ctx = Context(fresnelGraph=Graph().parse(data=lenses, format="turtle"),
+                      instanceGraph=graph)
+        ctx.fresnelCache.nativeSelectors = nativeSelectors
+        box = ContainerBox(ctx)
+        box.append(ex.alice)
+        out = io.BytesIO()
+        box.write(out, incremental=True)
+        return out.getvalue()
+
+    def testReopen(self):
+        graph = openGraph("PersistentMemory", self.configuration, create=True)
+        importInto(graph, self.source, "turtle")
+        graph.close()
+        graph = openGraph("PersistentMemory", self.configuration)
+        try:
+            self.assertEqual(len(graph), 2)
+            self.assertIn(b"Alice", self.render(graph, nativeSelectors=False))
+            self.assertIn(b"Alice", self.render(graph, nativeSelectors=True))
+        finally:
+            graph.close()
+
+    def testIdentifier(self):
+        graph = openGraph("PersistentMemory", self.configuration, identifier=ex.data, create=True)
+        importInto(graph, self.source, "turtle")
+        self.assertEqual(len(graph), 2)
+        graph.close()
+
+if __name__ == "__main__":
+    unittest.main()
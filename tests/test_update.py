@@ -0,0 +1,81 @@
+"""ContainerBox.update() with shared boxes
+
+    python3 -m unittest discover tests
+"""
+
+import logging
+import unittest
+
+from rdflib import Graph, Namespace, Literal, RDFS
+from lxml import etree
+
+from RDFFresnel import Context, ContainerBox
+
+foaf = Namespace("http://xmlns.com/foaf/0.1/")
+ex = Namespace("http://example.org/")
+
+lenses = """
+@prefix fresnel: <http://www.w3.org/2004/09/fresnel#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix : <http://example.org/lenses#> .
+
+:personLens a fresnel:Lens ;
+    fresnel:classLensDomain foaf:Person ;
+    fresnel:showProperties ( foaf:name ) .
+:propertyLabelLens a fresnel:Lens ;
+    fresnel:instanceLensDomain foaf:name ;
+    fresnel:purpose fresnel:labelLens ;
+    fresnel:showProperties ( rdfs:label ) .
+"""
+
+instances = """
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix ex: <http://example.org/> .
+
+foaf:name rdfs:label "name" .
+ex:alice a foaf:Person ; foaf:name "Alice" .
+ex:bob a foaf:Person ; foaf:name "Bob" .
+"""
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.fresnelGraph = Graph().parse(data=lenses, format="turtle")
+        self.instanceGraph = Graph().parse(data=instances, format="turtle")
+
+    def render(self, **options):
+        ctx = Context(fresnelGraph=self.fresnelGraph, instanceGraph=self.instanceGraph, **options)
+        box = ContainerBox(ctx)
+        box.extend([ex.alice, ex.bob])
+        box.select()
+        box.portray()
+        return box
+
+    def assertUpToDate(self, box):
+        fresh = self.render()
+        self.assertEqual(etree.tostring(box.transform()), etree.tostring(fresh.transform()))
+
+    def changeLabel(self, box):
+        removed = [(foaf.name, RDFS.label, None)]
+        added = [(foaf.name, RDFS.label, Literal("full name"))]
+        self.instanceGraph.remove(removed[0])
+        self.instanceGraph.add(added[0])
+        box.update(added=added, removed=removed)
+
+    def testSharedLabels(self):
+        # The label of foaf:name is selected once and shared by both
+        # resources
+        box = self.render(memo=dict(), dependencies=set())
+        self.changeLabel(box)
+        self.assertUpToDate(box)
+        self.assertEqual(etree.tostring(box.transform()).count(b"full name"), 2)
+
+    def testUnsharedLabels(self):
+        box = self.render(dependencies=set())
+        self.changeLabel(box)
+        self.assertUpToDate(box)
+
+if __name__ == "__main__":
+    unittest.main()